@@ -0,0 +1,361 @@
+"""
+Офлайн-замер конвейера бота на сохранённых страницах.
+
+Поднимает локальный HTTP-сервер со страницей заявок (10, 100 и 1000
+карточек) и чатом, запускает настоящий init_driver в headless Chrome и
+прогоняет safe_get, find_subject_requests, check_chat_state и
+process_card. Для каждого этапа печатает время, число запросов к
+WebDriver и пиковую память Chrome вместе с chromedriver.
+
+Страница тянет аватарки, веб-шрифт и счётчик, как настоящий сайт, поэтому
+прогон по профилям браузера (--profiles full lean) показывает выигрыш
+lean-профиля по памяти и времени загрузки.
+
+    python bench/bench.py                  # 10, 100, 1000 карточек
+    python bench/bench.py --cards 100 --orders 5 --json bench_output.txt
+    python bench/bench.py --profiles full lean
+"""
+
+import argparse
+import json
+import os
+import random
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+SUBJECTS = ["Математика", "Обществознание", "Физика", "Английский язык"]
+GOALS = ["Подготовка к ЕГЭ", "Подготовка к ОГЭ", "Школьная программа", "Олимпиада"]
+PLACES = ["Дистанционно", "У репетитора, м. Крылатское", "У ученика, м. Кунцевская"]
+STATIC_DELAY = 0.05  # Задержка "CDN" на каждую картинку, шрифт и счётчик
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES, name), encoding="utf-8") as f:
+        return f.read()
+
+def fill(template, **values):
+    """Подстановка {name} без str.format, чтобы не трогать фигурные скобки CSS/JS"""
+    for key, value in values.items():
+        template = template.replace("{" + key + "}", str(value))
+    return template
+
+def build_neworders_page(count, message, seed=1):
+    """Синтетическая страница заявок с count карточками; message - наш текст в чатах"""
+    rng = random.Random(seed)
+    card_template = read_fixture("neworders_card.html")
+    cards = []
+    for index in range(count):
+        order_id = 5000000 + index
+        cards.append(fill(
+            card_template,
+            id=order_id,
+            subject=SUBJECTS[index % len(SUBJECTS)],
+            goal=rng.choice(GOALS),
+            price=rng.choice([1000, 1500, 2000, 2500, 3000]),
+            place=rng.choice(PLACES),
+            posted=f"{rng.randint(1, 59)} минут назад",
+            responses=rng.randint(0, 12),
+            description=("Ученик 10 класса, нужна систематическая подготовка, занятия "
+                         "2 раза в неделю, удобное время - будни после 18:00. ") * 3,
+        ))
+    return fill(
+        read_fixture("page.html"),
+        cards="\n".join(cards),
+        chat=read_fixture("chat.html"),
+        script=fill(read_fixture("app.js"), our_message=json.dumps(message, ensure_ascii=False)),
+    )
+
+def make_png(size, seed):
+    """Несжимаемая PNG-картинка size x size: шум, как у настоящей фотографии"""
+    rng = random.Random(seed)
+    raw = b"".join(b"\x00" + rng.randbytes(size * 3) for _ in range(size))
+
+    def chunk(kind, data):
+        return (struct.pack(">I", len(data)) + kind + data
+                + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF))
+
+    header = struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header)
+            + chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b""))
+
+STATIC_FILES = {
+    ".png": ("image/png", make_png(96, seed=1)),
+    ".woff2": ("font/woff2", random.Random(2).randbytes(60_000)),
+    ".js": ("application/javascript", b"window.ym = function () {};" + b" " * 40_000),
+}
+
+class StubSite:
+    """Локальный сервер: /lk/teacher/neworders отдаёт страницу с текущим числом карточек"""
+
+    def __init__(self):
+        self.pages = {}
+        self.cards = 10
+        self.message = ""  # Текст бота подставляется после импорта bot
+        self.requests = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), partial(StubHandler, self))
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def page(self):
+        if self.cards not in self.pages:
+            self.pages[self.cards] = build_neworders_page(self.cards, self.message).encode("utf-8")
+        return self.pages[self.cards]
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+
+class StubHandler(SimpleHTTPRequestHandler):
+    def __init__(self, site, *args, **kwargs):
+        self.site = site
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        path = self.path.split("?")[0].rstrip("/")
+        content_type = "text/html; charset=utf-8"
+        static = next((item for ext, item in STATIC_FILES.items() if path.endswith(ext)), None)
+        if path == "/lk/teacher/neworders":
+            body = self.site.page()
+        elif static is not None:
+            time.sleep(STATIC_DELAY)
+            content_type, body = static
+        else:
+            body = b"<!DOCTYPE html><html><body><div>stub</div></body></html>"
+        self.site.requests += 1
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class MemorySampler:
+    """Фоновый замер пиковой памяти браузера"""
+
+    def __init__(self, rss, interval=0.2):
+        self.rss = rss
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, self.rss())
+            self.stopped.wait(self.interval)
+
+    def reset(self):
+        self.peak = self.rss()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+class Stage:
+    """Замер одного этапа: время, запросы к WebDriver, пиковая память"""
+
+    def __init__(self, results, name, commands, sampler, site):
+        self.results = results
+        self.name = name
+        self.commands = commands
+        self.sampler = sampler
+        self.site = site
+
+    def __enter__(self):
+        self.sampler.reset()
+        self.round_trips = self.commands()
+        self.http_requests = self.site.requests
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.results.append({
+            "stage": self.name,
+            "seconds": round(time.perf_counter() - self.started, 3),
+            "round_trips": self.commands() - self.round_trips,
+            "http_requests": self.site.requests - self.http_requests,
+            "peak_rss_mb": round(self.sampler.peak / 2**20, 1),
+        })
+        return False
+
+def fresh_store(bot, path):
+    """
+    Отдельная база на каждый прогон: иначе заявки, отправленные в прошлом
+    прогоне, завершаются по записи в базе без работы браузера
+    """
+    if bot.store is not None:
+        bot.store.close()
+        bot.store = None
+    bot.DB_FILE = path
+    bot.init_db()
+
+def run_case(bot, driver, site, cards, orders, sampler, workdir):
+    """Прогон конвейера на странице с cards карточками"""
+    site.cards = cards
+    fresh_store(bot, os.path.join(workdir, f"bench-{bot.BROWSER_PROFILE}-{cards}.db"))
+    results = []
+    # Команды WebDriver считает обёртка, которую ставит init_driver
+    stage = partial(Stage, results, commands=bot.webdriver_commands, sampler=sampler, site=site)
+
+    with stage("safe_get"):
+        bot.safe_get(driver, bot.ORDERS_LIST_URL)
+    with stage("find_subject_requests"):
+        found = bot.find_subject_requests(driver)
+
+    processed = set()
+    for request_card in found[:orders]:
+        with stage("resolve_card"):
+            request_card = bot.resolve_card(driver, request_card)
+        if request_card is None:
+            break
+        with stage("process_card"):
+            bot.process_card(driver, request_card, processed)
+        with stage("check_chat_state"):
+            # Без номера заявки - проверка по DOM, а не по записи в базе
+            bot.check_chat_state(driver, None, bot.MESSAGE)
+
+    for row in results:
+        row["cards"] = cards
+    return results
+
+def run_profile(bot, site, profile, cards_list, orders, workdir):
+    """Все размеры страниц на свежем Chrome с профилем profile"""
+    bot.BROWSER_PROFILE = profile
+    driver = bot.init_driver()
+    # Память chromedriver и всех процессов Chrome - тем же счётчиком, что у сторожа бота
+    sampler = MemorySampler(partial(bot.process_tree_rss, driver.service.process.pid))
+    sampler.start()
+
+    results = []
+    try:
+        for cards in cards_list:
+            print(f"=== {profile}: {cards} карточек ===")
+            results += run_case(bot, driver, site, cards, orders, sampler, workdir)
+    finally:
+        sampler.stop()
+        driver.quit()
+
+    for row in results:
+        row["profile"] = profile
+    return results
+
+def summarize(results):
+    """Сводка по этапам: среднее время, запросы к WebDriver и сайту, пик памяти"""
+    summary = {}
+    for row in results:
+        key = (row["profile"], row["cards"], row["stage"])
+        item = summary.setdefault(key, {"profile": row["profile"], "cards": row["cards"],
+                                        "stage": row["stage"], "runs": 0, "seconds": 0.0,
+                                        "round_trips": 0, "http_requests": 0, "peak_rss_mb": 0.0})
+        item["runs"] += 1
+        item["seconds"] += row["seconds"]
+        item["round_trips"] += row["round_trips"]
+        item["http_requests"] += row["http_requests"]
+        item["peak_rss_mb"] = max(item["peak_rss_mb"], row["peak_rss_mb"])
+    for item in summary.values():
+        item["seconds"] = round(item["seconds"] / item["runs"], 3)
+        item["round_trips"] = round(item["round_trips"] / item["runs"], 1)
+        item["http_requests"] = round(item["http_requests"] / item["runs"], 1)
+    return list(summary.values())
+
+def compare_profiles(summary, base="full", lean="lean"):
+    """Выигрыш lean-профиля против full по загрузке страницы и пиковой памяти"""
+    by_key = {(item["profile"], item["cards"], item["stage"]): item for item in summary}
+    rows = []
+    for (profile, cards, stage), item in by_key.items():
+        other = by_key.get((lean, cards, stage))
+        if profile != base or other is None or stage != "safe_get":
+            continue
+        rows.append({
+            "cards": cards,
+            "load_seconds": (item["seconds"], other["seconds"]),
+            "peak_rss_mb": (
+                max(i["peak_rss_mb"] for k, i in by_key.items() if k[:2] == (base, cards)),
+                max(i["peak_rss_mb"] for k, i in by_key.items() if k[:2] == (lean, cards)),
+            ),
+        })
+    return rows
+
+def print_table(summary):
+    print(f"{'профиль':<8} {'карточек':>9} {'этап':<24} {'прогонов':>8} {'сек':>8} "
+          f"{'запросов':>9} {'к сайту':>8} {'пик МБ':>8}")
+    for item in summary:
+        print(f"{item['profile']:<8} {item['cards']:>9} {item['stage']:<24} {item['runs']:>8} "
+              f"{item['seconds']:>8.3f} {item['round_trips']:>9} {item['http_requests']:>8} "
+              f"{item['peak_rss_mb']:>8.1f}")
+
+def print_comparison(rows):
+    if not rows:
+        return
+    print()
+    print(f"{'карточек':>9} {'загрузка full':>14} {'lean':>8} {'пик МБ full':>12} {'lean':>8} {'экономия МБ':>12}")
+    for row in rows:
+        (full_s, lean_s), (full_mb, lean_mb) = row["load_seconds"], row["peak_rss_mb"]
+        print(f"{row['cards']:>9} {full_s:>14.3f} {lean_s:>8.3f} {full_mb:>12.1f} {lean_mb:>8.1f} "
+              f"{full_mb - lean_mb:>12.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-замер конвейера бота")
+    parser.add_argument("--cards", type=int, nargs="+", default=[10, 100, 1000],
+                        help="размеры синтетических страниц")
+    parser.add_argument("--orders", type=int, default=3,
+                        help="сколько заявок обработать на каждой странице")
+    parser.add_argument("--profiles", nargs="+", choices=["full", "lean"], default=["full", "lean"],
+                        help="профили браузера для сравнения")
+    parser.add_argument("--json", metavar="FILE", help="сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    site = StubSite()
+    site.start()
+
+    # Настройки бота задаются до импорта: адрес стенда, отдельная база, без cookies
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    os.environ["BASE_URL"] = site.base_url
+    os.environ["COOKIES_FILE"] = os.path.join(workdir, "cookies.json")
+    os.environ.setdefault("ENGINE", "poll")
+    os.environ.setdefault("LIST_BACKEND", "browser")
+    # Лимит частоты отправки добавил бы паузы в замер process_card
+    os.environ.setdefault("SEND_MIN_INTERVAL", "0")
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import bot
+
+    site.message = bot.MESSAGE
+
+    results = []
+    try:
+        for profile in args.profiles:
+            results += run_profile(bot, site, profile, args.cards, args.orders, workdir)
+    finally:
+        site.stop()
+        if bot.store is not None:
+            bot.store.close()
+
+    summary = summarize(results)
+    print_table(summary)
+    comparison = compare_profiles(summary)
+    print_comparison(comparison)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"summary": summary, "comparison": comparison, "runs": results},
+                      f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены в {args.json}")
+
+if __name__ == "__main__":
+    main()
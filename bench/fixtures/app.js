@@ -0,0 +1,57 @@
+// Поведение страницы заявок, близкое к настоящему SPA: клик по карточке
+// открывает панель заявки с кнопкой чата, кнопка открывает чат, Enter в поле
+// ввода добавляет сообщение. В заявках с номером, кратным 3, уже есть наше
+// сообщение (текст bot.MESSAGE) - для проверки пути "сообщение уже было
+// отправлено".
+(function () {
+  const ourMessage = {our_message};
+  const detail = document.getElementById('detail');
+  const chatTemplate = document.getElementById('chat-template');
+
+  function bubble(text) {
+    const el = document.createElement('div');
+    el.className = 'css-146c3p1 r-bubble';
+    el.setAttribute('dir', 'auto');
+    el.textContent = text;
+    return el;
+  }
+
+  function openChat(orderId) {
+    detail.innerHTML = '';
+    detail.appendChild(chatTemplate.content.cloneNode(true));
+    const messages = detail.querySelector('.r-messages');
+    const input = detail.querySelector('textarea');
+    if (Number(orderId) % 3 === 0) {
+      messages.innerHTML = '';
+      messages.appendChild(bubble(ourMessage));
+      messages.appendChild(bubble('12:30'));
+    }
+    input.addEventListener('keydown', function (event) {
+      if (event.key !== 'Enter' || !input.value.trim()) return;
+      event.preventDefault();
+      const empty = messages.querySelector('.r-empty');
+      if (empty) empty.remove();
+      messages.appendChild(bubble(input.value));
+      input.value = '';
+    });
+  }
+
+  function openOrder(card) {
+    const orderId = card.getAttribute('data-order');
+    detail.hidden = false;
+    detail.innerHTML = '';
+    const title = document.createElement('div');
+    title.className = 'css-146c3p1';
+    title.textContent = 'Заявка № ' + orderId;
+    const button = document.createElement('div');
+    button.className = 'css-146c3p1 r-chat-button';
+    button.textContent = 'Начать чат с клиентом';
+    button.addEventListener('click', function () { openChat(orderId); });
+    detail.appendChild(title);
+    detail.appendChild(button);
+  }
+
+  document.querySelectorAll('.r-card').forEach(function (card) {
+    card.addEventListener('click', function () { openOrder(card); });
+  });
+})();
@@ -1,16 +1,64 @@
-import os
 import time
+
+# Отсчёт времени запуска - до всех импортов
+PROCESS_STARTED = time.monotonic()
+
+import os
 import random
+import math
 import re
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.common.keys import Keys
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import WebDriverException, TimeoutException, NoSuchElementException
+import json
+import functools
+import sys
+import argparse
+from datetime import datetime
+import importlib
+import subprocess
+from urllib.parse import urlencode
+import signal
+import contextlib
+import queue
+from selenium.common.exceptions import WebDriverException, TimeoutException, NoSuchElementException, StaleElementReferenceException
 from dotenv import load_dotenv
 import sqlite3
+from html.parser import HTMLParser
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+class LazyImport:
+    """
+    Модуль или объект из модуля, который импортируется при первом обращении.
+    Пакет selenium.webdriver при импорте тянет драйверы всех браузеров, поэтому
+    откладываем его до запуска Chrome, который идёт параллельно с базой.
+    """
+
+    def __init__(self, module, attr=None):
+        self._module = module
+        self._attr = attr
+        self._target = None
+
+    def _resolve(self):
+        if self._target is None:
+            target = importlib.import_module(self._module)
+            self._target = getattr(target, self._attr) if self._attr else target
+        return self._target
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+webdriver = LazyImport("selenium.webdriver")
+By = LazyImport("selenium.webdriver.common.by", "By")
+Keys = LazyImport("selenium.webdriver.common.keys", "Keys")
+Options = LazyImport("selenium.webdriver.chrome.options", "Options")
+Service = LazyImport("selenium.webdriver.chrome.service", "Service")
+WebDriverWait = LazyImport("selenium.webdriver.support.ui", "WebDriverWait")
+urllib3 = LazyImport("urllib3")
 
 # ===== ЗАГРУЗКА .env =====
 load_dotenv()
@@ -19,10 +67,80 @@ LOGIN = os.getenv("LOGIN")
 PASSWORD = os.getenv("PASSWORD")
 MESSAGE = "Здравствуйте! Качественно и компетентно помогу справиться с вашей задачей. Первое занятие со скидкой 50%, при записи до конца дня. Обо мне: образование МГУ, опыт работы более 15 лет с более чем 1000 учениками: индивидуально, на курсах, в школе, работа в качестве эксперта. Работаю на результат, при этом стремлюсь объяснить материал понятно и просто, что позволяет изменить отношение к предмету к лучшему. Провожу занятия через платформу Zoom, используя все доступные современные технологии, или очно в 5 минутах пешком от метро Крылатское. По запросу предоставляю записи занятий. Есть сотни положительных отзывов о моей работе, часть из них можно посмотреть на этой платформе"
 CHECK_INTERVAL = 60 
+POLL_MIN_INTERVAL = 20       # Самый частый опрос в активные часы, сек
+POLL_MAX_INTERVAL = 300      # Самый редкий опрос в тихие часы, сек
+POLL_JITTER = 0.2            # Случайный разброс интервала, +-20%
+ACTIVITY_HISTORY_DAYS = 30   # За сколько дней учитываем время прихода заявок
+ACTIVITY_MIN_ORDERS = 50     # Меньше заявок в истории - опрашиваем с CHECK_INTERVAL
+ACTIVITY_MIN_DAYS = 3        # ...и они должны прийти хотя бы за столько разных дней
+BACKOFF_BASE = 10            # Первая пауза после ошибки, сек
+BACKOFF_MAX = 600            # Предел паузы после ошибок, сек
+MAX_POLLS_PER_HOUR = int(os.getenv("MAX_POLLS_PER_HOUR", "120"))
+DAILY_POLL_CAP = int(os.getenv("DAILY_POLL_CAP", "2000"))
+BASE_URL = os.getenv("BASE_URL", "https://repetit.ru")
+LOGIN_URL = f"{BASE_URL}/lk/loginwithpassword"
+NEWORDERS_URL = f"{BASE_URL}/lk/teacher/neworders"
 DB_FILE = "processed_requests.db"
+COOKIES_FILE = os.getenv("COOKIES_FILE", "session_cookies.json")  # Cookies авторизованной сессии
+CHROMEDRIVER_PATH = os.getenv("CHROMEDRIVER_PATH")  # Без него chromedriver ищет selenium-manager
+CHROME_BIN = os.getenv("CHROME_BIN")
+DRIVER_CACHE_FILE = os.getenv("DRIVER_CACHE_FILE", "chromedriver_cache.json")  # Результат проверки версий
+MAX_SOFT_RESETS = 3  # Сколько раз подряд сбрасывать вкладку, прежде чем перезапускать Chrome
+STALE_RETRIES = 3  # Сколько раз искать заново элемент, устаревший после перерисовки
+WATCHDOG_INTERVAL = 15  # Как часто сторож проверяет браузер, сек
+WATCHDOG_HANG_TIMEOUT = 90  # Браузер не отвечает дольше - считаем зависшим и убиваем
+BROWSER_MAX_RSS_MB = int(os.getenv("BROWSER_MAX_RSS_MB", "650"))  # Память Chrome + chromedriver
+BROWSER_MAX_UPTIME = int(os.getenv("BROWSER_MAX_UPTIME", str(6 * 3600)))  # Перезапуск Chrome не реже, сек
+DB_COMMIT_EVERY = 5        # Коммит после стольких записей...
+DB_COMMIT_INTERVAL = 2.0   # ...или не реже, чем раз в столько секунд
 SPEED_FACTOR = 1
 TYPING_SPEED_FACTOR = 4
 CAN_SEND_MESSAGE = True
+BATCH_MODE = True  # Один раз загружаем список заявок и обрабатываем всю очередь
+WAIT_MODE = os.getenv("WAIT_MODE", "event")  # "event" - ждём состояние страницы, "sleep" - фиксированные паузы
+WAIT_POLL_INTERVAL = 0.1  # Как часто проверять условие ожидания, сек
+INPUT_MODE = os.getenv("INPUT_MODE", "insert")  # "insert" - вставка целиком, "chunk" - кусками, "char" - по символу
+INPUT_CHUNK_SIZE = 50
+ENGINE = os.getenv("ENGINE", "poll")  # "poll" - перезагрузка раз в CHECK_INTERVAL, "cdp" - по сетевым событиям
+ORDERS_XHR_PATTERN = os.getenv("ORDERS_XHR_PATTERN", r"order")  # URL ответов со списком заявок
+CDP_POLL_INTERVAL = 0.5  # Как часто читать сетевые события, сек
+CDP_FALLBACK_RELOAD = CHECK_INTERVAL  # Полная перезагрузка списка не реже, сек
+LIST_BACKEND = os.getenv("LIST_BACKEND", "browser")  # "browser" или "http" - список заявок без браузера
+LIST_FETCH_URL = os.getenv("LIST_FETCH_URL")  # Страница или JSON API со списком заявок (по умолчанию ORDERS_LIST_URL)
+JSON_LOG_FILE = os.getenv("JSON_LOG_FILE")  # Файл для структурированных JSON-событий
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # Порт для /metrics, 0 - выключено
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+
+# ===== ПРОФИЛЬ БРАУЗЕРА =====
+# "lean" - без картинок, шрифтов, медиа и счётчиков, маленькое окно и eager-загрузка;
+# "full" - прежний полный Chrome
+BROWSER_PROFILE = os.getenv("BROWSER_PROFILE", "lean")
+WINDOW_SIZE = os.getenv("WINDOW_SIZE", "1280,800")  # Окно lean-профиля: ширина,высота
+BLOCKED_URLS = [
+    "*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.avif", "*.svg", "*.ico",
+    "*.woff", "*.woff2", "*.ttf", "*.otf", "*.eot",
+    "*.mp4", "*.webm", "*.mp3", "*.ogg",
+    "*google-analytics.com*", "*googletagmanager.com*", "*mc.yandex.ru*",
+    "*doubleclick.net*", "*connect.facebook.net*", "*top-fwz1.mail.ru*", "*vk.com/rtrg*",
+] + [url for url in os.getenv("BLOCKED_URLS", "").split(",") if url]
+LEAN_CHROME_FLAGS = [
+    "--blink-settings=imagesEnabled=false",
+    "--disable-background-networking",
+    "--disable-component-update",
+    "--disable-default-apps",
+    "--disable-sync",
+    "--disable-translate",
+    "--disable-features=Translate,MediaRouter,OptimizationHints,AutofillServerCommunication",
+    "--no-first-run",
+    "--no-default-browser-check",
+    "--mute-audio",
+    "--metrics-recording-only",
+    # Вкладки пула работают в фоне - не даём Chrome их притормаживать
+    "--disable-background-timer-throttling",
+    "--disable-backgrounding-occluded-windows",
+    "--disable-renderer-backgrounding",
+    "--js-flags=--max-old-space-size=256",
+]
 
 # ===== МАССИВ ПРЕДМЕТОВ ДЛЯ ПОИСКА =====
 SUBJECTS_TO_SEARCH = [
@@ -30,43 +148,765 @@ SUBJECTS_TO_SEARCH = [
     "Обществознание",
 ]
 
-def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS processed_requests (
-            id TEXT PRIMARY KEY
+# Необязательные настройки предметов: синонимы, слова-исключения, минимальная
+# цена (в рублях) и вес предмета в приоритете очереди. Все формы слова
+# ("математике", "математикой") находятся автоматически, сюда нужно писать
+# только другие названия.
+SUBJECT_CONFIG = {
+    "Математика": {
+        "aliases": ["алгебра", "геометрия", "высшая математика"],
+        "exclude": [],
+        "min_price": 0,
+        "weight": 1.0,
+        "site_filter": None,  # значение предмета в фильтре сайта (из адреса списка после выбора предмета)
+    },
+    "Обществознание": {
+        "aliases": [],
+        "exclude": [],
+        "min_price": 0,
+        "weight": 1.0,
+        "site_filter": None,
+    },
+}
+
+# ===== ФИЛЬТР ПРЕДМЕТОВ НА СТОРОНЕ САЙТА =====
+# Если у всех предметов задан site_filter, список заявок открывается сразу с
+# фильтром сайта (?SUBJECT_FILTER_PARAM=...), и страница содержит только
+# нужные карточки. Сопоставление предметов в боте остаётся как проверка.
+SUBJECT_FILTER_PARAM = os.getenv("SUBJECT_FILTER_PARAM", "")  # Имя параметра фильтра в адресе списка
+
+def subject_filter_query():
+    """Параметры фильтра по предметам для адреса списка или "", если фильтр не настроен"""
+    if not SUBJECT_FILTER_PARAM:
+        return ""
+    values = [SUBJECT_CONFIG.get(subject, {}).get("site_filter") for subject in SUBJECTS_TO_SEARCH]
+    if not all(values):
+        # Без значения хотя бы одного предмета фильтр сайта спрятал бы его заявки
+        print("Фильтр сайта по предметам не включён: site_filter задан не у всех предметов")
+        return ""
+    return urlencode([(SUBJECT_FILTER_PARAM, value) for value in values])
+
+LIST_FILTER_QUERY = subject_filter_query()
+ORDERS_LIST_URL = f"{NEWORDERS_URL}?{LIST_FILTER_QUERY}" if LIST_FILTER_QUERY else NEWORDERS_URL
+LIST_FILTER_LEAK_SHARE = 0.5  # Доля чужих карточек, при которой считаем, что фильтр сайта не сработал
+
+# ===== ПРИОРИТЕТ ЗАЯВОК =====
+PRIORITY_WEIGHTS = {
+    "price": 1.0,        # за каждую 1000 ₽ цены
+    "freshness": 2.0,    # свежая заявка, убывает вдвое каждые FRESHNESS_HALF_LIFE минут
+    "competition": 0.2,  # штраф за каждый отклик других репетиторов
+}
+FRESHNESS_HALF_LIFE = 15  # мин
+MAX_ORDER_ATTEMPTS = 3    # Сколько раз пробовать заявку, прежде чем сдаться
+
+# ===== ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА =====
+WORKER_TABS = int(os.getenv("WORKER_TABS", "1"))  # Вкладок в пуле: 1 - без пула, последовательно
+SEND_MIN_INTERVAL = float(os.getenv("SEND_MIN_INTERVAL", "5"))  # Не чаще одной отправки за столько секунд
+
+# ===== МЕТРИКИ И ПРОФИЛИРОВАНИЕ =====
+# Счетчики (METRICS), текущие значения (GAUGES), гистограммы (HISTOGRAMS) и замеры этапов (span).
+# Все команды WebDriver считаются и замеряются обёрткой над driver.execute.
+# События этапов пишутся JSON-строками в JSON_LOG_FILE, а при METRICS_PORT
+# метрики отдаются в формате Prometheus на http://127.0.0.1:METRICS_PORT/metrics.
+
+METRICS = {}
+GAUGES = {}
+HISTOGRAMS = {}
+metrics_lock = threading.Lock()
+
+# Границы корзин гистограмм по умолчанию, сек
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+COUNT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+def record_metric(name, value=1):
+    """Увеличивает счетчик метрики"""
+    with metrics_lock:
+        METRICS[name] = METRICS.get(name, 0) + value
+
+def set_gauge(name, value):
+    """Запоминает текущее значение метрики"""
+    with metrics_lock:
+        GAUGES[name] = value
+
+def observe(name, value, buckets=SECONDS_BUCKETS, **labels):
+    """Добавляет наблюдение в гистограмму name с метками labels"""
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        histogram = HISTOGRAMS.get(key)
+        if histogram is None:
+            histogram = HISTOGRAMS[key] = {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0}
+        for index, bound in enumerate(histogram["buckets"]):
+            if value <= bound:
+                histogram["counts"][index] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+def log_event(event, **fields):
+    """Структурированное событие одной JSON-строкой в JSON_LOG_FILE"""
+    if not JSON_LOG_FILE:
+        return
+    record = {"ts": round(time.time(), 3), "event": event, **fields}
+    line = json.dumps(record, ensure_ascii=False, default=str)
+    with metrics_lock:
+        with open(JSON_LOG_FILE, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+def webdriver_commands():
+    """Сколько команд WebDriver выполнено с начала работы"""
+    return METRICS.get("webdriver_commands_total", 0)
+
+class span:
+    """
+    Замер этапа конвейера: время и число команд WebDriver.
+        with span("open_chat", req_id=req_id): ...
+    """
+
+    def __init__(self, stage, req_id=None):
+        self.stage = stage
+        self.req_id = req_id
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        self.commands = webdriver_commands()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.seconds = time.monotonic() - self.started
+        round_trips = webdriver_commands() - self.commands
+        observe("stage_seconds", self.seconds, stage=self.stage)
+        if self.req_id and store is not None:
+            store.add_event(self.req_id, "span", detail=self.stage, seconds=round(self.seconds, 3))
+        log_event(
+            "span",
+            stage=self.stage,
+            req_id=self.req_id,
+            seconds=round(self.seconds, 3),
+            round_trips=round_trips,
+            error=exc_type.__name__ if exc_type else None,
+        )
+        return False
+
+def traced(stage):
+    """Декоратор: вся функция - один этап для span"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def instrument_driver(driver):
+    """Оборачиваем driver.execute: через него проходят все команды, включая команды элементов"""
+    original_execute = driver.execute
+
+    def timed_execute(driver_command, params=None):
+        started = time.monotonic()
+        try:
+            response = original_execute(driver_command, params)
+            # Браузер только что ответил - сторожу не нужно проверять его отдельно
+            driver.last_command_ok = time.monotonic()
+            return response
+        finally:
+            elapsed = time.monotonic() - started
+            record_metric("webdriver_commands_total")
+            record_metric("webdriver_seconds_total", elapsed)
+            observe("webdriver_command_seconds", elapsed, command=driver_command)
+
+    driver.execute = timed_execute
+    driver.last_command_ok = time.monotonic()
+    return driver
+
+def metric_name(name):
+    return "bot_" + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{str(value).replace(chr(34), chr(39))}"' for key, value in pairs) + "}"
+
+def prometheus_metrics():
+    """Текст метрик в формате Prometheus"""
+    lines = []
+    with metrics_lock:
+        for name, value in sorted(METRICS.items()):
+            lines.append(f"# TYPE {metric_name(name)} counter")
+            lines.append(f"{metric_name(name)} {value}")
+        for name, value in sorted(GAUGES.items()):
+            lines.append(f"# TYPE {metric_name(name)} gauge")
+            lines.append(f"{metric_name(name)} {value}")
+        typed = set()
+        for (name, labels), histogram in sorted(HISTOGRAMS.items()):
+            full_name = metric_name(name)
+            if full_name not in typed:
+                lines.append(f"# TYPE {full_name} histogram")
+                typed.add(full_name)
+            for bound, count in zip(histogram["buckets"], histogram["counts"]):
+                lines.append(f"{full_name}_bucket{format_labels(labels, [('le', bound)])} {count}")
+            lines.append(f"{full_name}_bucket{format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+            lines.append(f"{full_name}_sum{format_labels(labels)} {histogram['sum']}")
+            lines.append(f"{full_name}_count{format_labels(labels)} {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+def metrics_snapshot():
+    """Метрики в виде словаря для /metrics.json"""
+    with metrics_lock:
+        return {
+            "counters": dict(METRICS),
+            "gauges": dict(GAUGES),
+            "histograms": [
+                {"name": name, "labels": dict(labels), **histogram}
+                for (name, labels), histogram in HISTOGRAMS.items()
+            ],
+        }
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = prometheus_metrics().encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif self.path == "/metrics.json":
+            body = json.dumps(metrics_snapshot(), ensure_ascii=False).encode("utf-8")
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server():
+    """Поднимаем /metrics на localhost, если задан METRICS_PORT"""
+    if not METRICS_PORT:
+        return None
+    server = ThreadingHTTPServer(("127.0.0.1", METRICS_PORT), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Метрики доступны на http://127.0.0.1:{METRICS_PORT}/metrics")
+    return server
+
+# Статусы заявки в очереди order_queue
+ORDER_PENDING = "pending"
+ORDER_IN_PROGRESS = "in_progress"
+ORDER_DONE = "done"
+ORDER_FAILED = "failed"
+ORDER_GONE = "gone"  # пропала из списка до обработки
+
+# Этапы обработки заявки. Каждый переход сразу фиксируется в базе, и после
+# падения работа продолжается с последнего записанного этапа
+STAGE_DISCOVERED = "discovered"    # заявка в очереди
+STAGE_CHAT_OPENED = "chat_opened"  # чат с клиентом открыт
+STAGE_TYPED = "typed"              # текст набран в поле
+STAGE_SENT = "sent"                # Enter нажат, отправка записана
+STAGE_CONFIRMED = "confirmed"      # сообщение появилось в чате
+STAGES = [STAGE_DISCOVERED, STAGE_CHAT_OPENED, STAGE_TYPED, STAGE_SENT, STAGE_CONFIRMED]
+
+# Итоги обработки заявки
+OUTCOME_SENT = "sent"
+OUTCOME_ALREADY_SENT = "already-sent"
+OUTCOME_NO_CHAT = "no-chat"
+OUTCOME_CHAT_BUSY = "chat-busy"  # в чате уже есть чужие сообщения
+OUTCOME_SKIPPED = "skipped"  # отправка отключена через CAN_SEND_MESSAGE
+OUTCOME_ERROR = "error"
+
+# Состояние чата заявки
+CHAT_EMPTY = "empty"    # сообщений нет, можно писать
+CHAT_OURS = "ours"      # наше сообщение уже есть
+CHAT_OTHERS = "others"  # есть сообщения, но не наши
+CHAT_UNKNOWN = "unknown"  # чат не загрузился: повторим заявку позже
+CHAT_CHECK_TIMEOUT = 2  # Сколько ждать, пока чат покажет сообщения или пустой блок
+
+class ProcessedStore:
+    """
+    Хранилище обработанных заявок на одном долгоживущем соединении SQLite.
+    Журнал WAL, коммиты пачками, множество номеров заявок в памяти
+    дополняется только новыми строками.
+    """
+
+    def __init__(self, path, commit_every=DB_COMMIT_EVERY, commit_interval=DB_COMMIT_INTERVAL):
+        self.path = path
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.ids = set()
+        self.last_rowid = 0
+        self.pending = 0
+        self.last_commit = time.monotonic()
+        self.lock = threading.RLock()
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.create_schema()
+
+    def create_schema(self):
+        cur = self.conn.cursor()
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS processed_requests (
+                id TEXT PRIMARY KEY
+            )
+        """)
+        # Старые базы содержат только id - добавляем недостающие колонки
+        columns = {row[1] for row in cur.execute("PRAGMA table_info(processed_requests)")}
+        for name, column_type in (
+            ("subject", "TEXT"),
+            ("processed_at", "REAL"),
+            ("outcome", "TEXT"),
+            ("duration", "REAL"),
+        ):
+            if name not in columns:
+                cur.execute(f"ALTER TABLE processed_requests ADD COLUMN {name} {column_type}")
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_processed_requests_processed_at
+            ON processed_requests (processed_at)
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS order_queue (
+                id TEXT PRIMARY KEY,
+                subject TEXT,
+                price INTEGER,
+                posted_minutes REAL,
+                responses INTEGER,
+                score REAL NOT NULL DEFAULT 0,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                first_seen REAL,
+                updated_at REAL
+            )
+        """)
+        queue_columns = {row[1] for row in cur.execute("PRAGMA table_info(order_queue)")}
+        if "stage" not in queue_columns:
+            cur.execute(f"ALTER TABLE order_queue ADD COLUMN stage TEXT NOT NULL DEFAULT '{STAGE_DISCOVERED}'")
+        if "posted_at" not in queue_columns:
+            # Когда заявку опубликовали: свежесть считается от него при выборке
+            cur.execute("ALTER TABLE order_queue ADD COLUMN posted_at REAL")
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_order_queue_status_score
+            ON order_queue (status, score)
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS sent_messages (
+                id TEXT PRIMARY KEY,
+                message TEXT NOT NULL,
+                sent_at REAL NOT NULL
+            )
+        """)
+        # Журнал жизни заявок: только добавление, выборки - по окну времени
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS order_events (
+                ts REAL NOT NULL,
+                req_id TEXT NOT NULL,
+                event TEXT NOT NULL,
+                detail TEXT,
+                seconds REAL
+            )
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_order_events_ts ON order_events (ts)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_order_events_req ON order_events (req_id, event)")
+        # Момент первого появления заявки записывается один раз
+        cur.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_order_events_first_seen
+            ON order_events (req_id) WHERE event = 'first_seen'
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS card_locators (
+                selector TEXT PRIMARY KEY,
+                hits INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        self.conn.commit()
+
+    def refresh(self):
+        """Догружает в память только строки, появившиеся после прошлого чтения"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT rowid, id FROM processed_requests WHERE rowid > ? ORDER BY rowid",
+                (self.last_rowid,),
+            ).fetchall()
+            for rowid, req_id in rows:
+                self.ids.add(req_id)
+                self.last_rowid = rowid
+            return self.ids
+
+    def save(self, req_id, subject=None, outcome=OUTCOME_SENT, duration=None):
+        with self.lock:
+            self.conn.execute("""
+                INSERT INTO processed_requests (id, subject, processed_at, outcome, duration)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                    subject = excluded.subject,
+                    processed_at = excluded.processed_at,
+                    outcome = excluded.outcome,
+                    duration = excluded.duration
+            """, (req_id, subject, time.time(), outcome, duration))
+            self.ids.add(req_id)
+            self.pending += 1
+            self.maybe_commit()
+
+    def maybe_commit(self):
+        if (self.pending >= self.commit_every
+                or time.monotonic() - self.last_commit >= self.commit_interval):
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.pending:
+                self.conn.commit()
+                self.pending = 0
+            self.last_commit = time.monotonic()
+
+    def hourly_activity(self, days):
+        """
+        Когда приходят заявки: число первых появлений в списке по часам суток
+        (местное время) за days дней и число разных дней, за которые они есть.
+        """
+        since = time.time() - days * 86400
+        with self.lock:
+            rows = self.conn.execute("""
+                SELECT CAST(strftime('%H', ts, 'unixepoch', 'localtime') AS INTEGER), COUNT(*)
+                FROM order_events
+                WHERE event = 'first_seen' AND ts >= ?
+                GROUP BY 1
+            """, (since,)).fetchall()
+            distinct_days = self.conn.execute("""
+                SELECT COUNT(DISTINCT date(ts, 'unixepoch', 'localtime'))
+                FROM order_events
+                WHERE event = 'first_seen' AND ts >= ?
+            """, (since,)).fetchone()[0]
+            return {hour: count for hour, count in rows}, distinct_days
+
+    def enqueue_cards(self, cards):
+        """Добавляет карточки в очередь или обновляет их оценку; статус и попытки не трогаем"""
+        now = time.time()
+        rows = []
+        for card in cards:
+            posted_minutes = parse_posted_minutes(card["text"])
+            posted_at = card["seen_at"] - (posted_minutes or 0) * 60
+            rows.append((card["id"], card["subject"], parse_price(card["price"]), posted_minutes,
+                         parse_responses(card["text"]), score_card(card), posted_at, now, now))
+        with self.lock:
+            self.conn.executemany("""
+                INSERT INTO order_queue
+                    (id, subject, price, posted_minutes, responses, score, posted_at, first_seen, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                    subject = excluded.subject,
+                    price = excluded.price,
+                    posted_minutes = excluded.posted_minutes,
+                    responses = excluded.responses,
+                    score = excluded.score,
+                    posted_at = COALESCE(order_queue.posted_at, excluded.posted_at),
+                    status = CASE WHEN status = 'gone' THEN 'pending' ELSE status END,
+                    updated_at = excluded.updated_at
+            """, rows)
+            self.add_first_seen(cards)
+
+    def next_orders(self, limit, exclude=()):
+        """
+        Верх очереди: новые заявки и заявки с неудачными попытками, по убыванию
+        оценки. Оценка считается на момент выборки: заявка, которая ждёт в
+        очереди, теряет свежесть, даже если список с тех пор не менялся.
+        """
+        now = time.time()
+        with self.lock:
+            rows = self.conn.execute("""
+                SELECT id, subject, price, responses, COALESCE(posted_at, first_seen, ?), first_seen
+                FROM order_queue
+                WHERE status = ? OR (status = ? AND attempts < ?)
+            """, (now, ORDER_PENDING, ORDER_FAILED, MAX_ORDER_ATTEMPTS)).fetchall()
+        ranked = sorted(
+            (row for row in rows if row[0] not in exclude and row[0] not in self.ids),
+            key=lambda row: (-order_score(row[1], row[2] or 0, (now - row[4]) / 60, row[3] or 0), row[5] or 0),
         )
-    """)
-    conn.commit()
-    conn.close()
+        return [(req_id, subject) for req_id, subject, *_ in ranked[:limit]]
+
+    def mark_order(self, req_id, status):
+        with self.lock:
+            self.conn.execute("""
+                INSERT INTO order_queue (id, status, first_seen, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET status = excluded.status, updated_at = excluded.updated_at
+            """, (req_id, status, time.time(), time.time()))
+            self.pending += 1
+            self.maybe_commit()
+
+    def mark_order_failed(self, req_id):
+        """Отмечает неудачную попытку и возвращает число попыток"""
+        with self.lock:
+            self.conn.execute("""
+                INSERT INTO order_queue (id, status, attempts, first_seen, updated_at) VALUES (?, ?, 1, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                    status = excluded.status,
+                    attempts = attempts + 1,
+                    updated_at = excluded.updated_at
+            """, (req_id, ORDER_FAILED, time.time(), time.time()))
+            self.flush()
+            return self.conn.execute("SELECT attempts FROM order_queue WHERE id = ?", (req_id,)).fetchone()[0]
+
+    def requeue_interrupted(self):
+        """Заявки, обработка которых оборвалась (бот упал), возвращаем в очередь"""
+        with self.lock:
+            count = self.conn.execute(
+                "UPDATE order_queue SET status = ? WHERE status = ?", (ORDER_PENDING, ORDER_IN_PROGRESS)
+            ).rowcount
+            self.conn.commit()
+            return count
+
+    def record_sent(self, req_id, message):
+        """Запоминаем отправленное сообщение сразу, до всех остальных отметок"""
+        with self.lock:
+            self.conn.execute("""
+                INSERT INTO sent_messages (id, message, sent_at) VALUES (?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET message = excluded.message, sent_at = excluded.sent_at
+            """, (req_id, message, time.time()))
+            # Этап "отправлено" - в той же транзакции, что и запись об отправке
+            self.set_stage(req_id, STAGE_SENT)
+
+    def set_stage(self, req_id, stage):
+        """Переход заявки на этап stage; коммитится сразу вместе с событием в журнале"""
+        now = time.time()
+        with self.lock:
+            self.conn.execute("""
+                INSERT INTO order_queue (id, stage, first_seen, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET stage = excluded.stage, updated_at = excluded.updated_at
+            """, (req_id, stage, now, now))
+            self.add_event(req_id, stage, ts=now)
+            self.flush()
+
+    def add_event(self, req_id, event, detail=None, seconds=None, ts=None):
+        """Событие в журнале order_events; коммит - вместе с остальными записями"""
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO order_events (ts, req_id, event, detail, seconds) VALUES (?, ?, ?, ?, ?)",
+                (ts or time.time(), req_id, event, detail, seconds),
+            )
+            self.pending += 1
+            self.maybe_commit()
+
+    def add_first_seen(self, cards):
+        """Момент, когда заявку впервые увидели в списке (повторные игнорируются)"""
+        with self.lock:
+            self.conn.executemany("""
+                INSERT OR IGNORE INTO order_events (ts, req_id, event, detail)
+                VALUES (?, ?, 'first_seen', ?)
+            """, [(card["seen_at"], card["id"], card["subject"]) for card in cards if card["id"]])
+            self.pending += 1
+            self.maybe_commit()
+
+    def first_seen_at(self, req_id):
+        """Когда заявку впервые увидели: событие first_seen или запись в очереди"""
+        with self.lock:
+            row = self.conn.execute("""
+                SELECT COALESCE(
+                    (SELECT ts FROM order_events WHERE req_id = ? AND event = 'first_seen'),
+                    (SELECT first_seen FROM order_queue WHERE id = ?))
+            """, (req_id, req_id)).fetchone()
+            return row[0] if row else None
+
+    def order_stage(self, req_id):
+        with self.lock:
+            row = self.conn.execute("SELECT stage FROM order_queue WHERE id = ?", (req_id,)).fetchone()
+            return row[0] if row else STAGE_DISCOVERED
+
+    def was_sent(self, req_id):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT 1 FROM sent_messages WHERE id = ?", (req_id,)
+            ).fetchone() is not None
+
+    def sent_texts(self, limit=20):
+        """Разные тексты, которые мы отправляли в последнее время"""
+        with self.lock:
+            rows = self.conn.execute("""
+                SELECT message FROM sent_messages
+                GROUP BY message ORDER BY MAX(sent_at) DESC LIMIT ?
+            """, (limit,)).fetchall()
+            return [message for (message,) in rows]
+
+    def load_card_locators(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT selector, hits FROM card_locators").fetchall()
+            return {selector: hits for selector, hits in rows}
+
+    def save_card_locators(self, hits):
+        with self.lock:
+            self.conn.executemany("""
+                INSERT INTO card_locators (selector, hits) VALUES (?, ?)
+                ON CONFLICT(selector) DO UPDATE SET hits = hits + excluded.hits
+            """, list(hits.items()))
+            self.pending += 1
+            self.maybe_commit()
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.conn.close()
+
+store = None
+
+def init_db():
+    global store
+    if store is None:
+        store = ProcessedStore(DB_FILE)
+        interrupted = store.requeue_interrupted()
+        if interrupted:
+            print(f"Возвращено в очередь прерванных заявок: {interrupted}, "
+                  f"они продолжатся с последнего записанного этапа")
+    return store
 
 def load_processed_requests():
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("SELECT id FROM processed_requests")
-    rows = cur.fetchall()
-    conn.close()
-    return set(r[0] for r in rows)
-
-def save_processed_request(req_id: str):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    try:
-        cur.execute("INSERT OR IGNORE INTO processed_requests (id) VALUES (?)", (req_id,))
-        conn.commit()
-    finally:
-        conn.close()
+    """Множество обработанных заявок, дополненное новыми строками из базы"""
+    return init_db().refresh()
 
-def extract_request_id(card_element):
-    """Ищем номер заявки внутри карточки"""
-    text = card_element.text
+def save_processed_request(req_id: str, subject=None, outcome=OUTCOME_SENT, duration=None):
+    init_db().save(req_id, subject=subject, outcome=outcome, duration=duration)
+
+def load_card_locators():
+    """Загружаем локаторы карточек, выученные на прошлых запусках"""
+    return init_db().load_card_locators()
+
+def save_card_locators(hits: dict):
+    init_db().save_card_locators(hits)
+
+def order_stage(req_id):
+    return init_db().order_stage(req_id)
+
+def advance_stage(req_id, stage):
+    """Переводим заявку на следующий этап (назад этапы не откатываются)"""
+    if req_id and STAGES.index(stage) > STAGES.index(order_stage(req_id)):
+        init_db().set_stage(req_id, stage)
+
+def extract_request_id(card):
+    """Ищем номер заявки внутри карточки (снимок или живой элемент)"""
+    if isinstance(card, dict):
+        return card.get("id")
+    text = card.text
     match = re.search(r"№\s*(\d+)", text)
     return match.group(1) if match else None
 
+def apply_tab_profile(driver):
+    """
+    Настройки lean-профиля, которые CDP применяет к отдельной вкладке:
+    блокировка картинок, шрифтов, медиа и счётчиков. Нужно вызывать для
+    каждой новой вкладки.
+    """
+    if BROWSER_PROFILE != "lean":
+        return
+    try:
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": BLOCKED_URLS})
+    except WebDriverException as e:
+        print(f"Не удалось включить блокировку ресурсов: {e}")
+
+# ===== ПРОВЕРКА CHROMEDRIVER =====
+# Без явного пути Selenium на каждом запуске зовёт selenium-manager, который
+# ищет Chrome и подбирает chromedriver. После удачного запуска запоминаем в
+# DRIVER_CACHE_FILE рабочий chromedriver и фактическую версию Chrome из
+# capabilities сессии. Пока настройки и файл chromedriver не поменялись,
+# следующие запуски берут его сразу. Если Chrome обновился и сессия с
+# кэшированным chromedriver не создаётся, кэш сбрасывается и chromedriver
+# заново подбирает selenium-manager.
+
+def file_signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [path, stat.st_mtime, stat.st_size]
+
+def program_major_version(path):
+    """Старший номер версии из вывода `path --version`"""
+    try:
+        output = subprocess.run([path, "--version"], capture_output=True, text=True, timeout=15).stdout
+    except (OSError, subprocess.SubprocessError):
+        return None
+    match = re.search(r"(\d+)\.\d+", output)
+    return int(match.group(1)) if match else None
+
+def major_version(version):
+    match = re.match(r"(\d+)\.", version or "")
+    return int(match.group(1)) if match else None
+
+def load_driver_cache():
+    try:
+        with open(DRIVER_CACHE_FILE, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_driver_cache(cache):
+    try:
+        with open(DRIVER_CACHE_FILE, "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+    except OSError as e:
+        print(f"Не удалось сохранить проверку chromedriver: {e}")
+
+def clear_driver_cache():
+    try:
+        os.remove(DRIVER_CACHE_FILE)
+    except OSError:
+        pass
+
+def driver_settings_signature():
+    """Настройки, при которых кэш действителен: заданные пути и их файлы"""
+    return {
+        "driver": file_signature(CHROMEDRIVER_PATH) if CHROMEDRIVER_PATH else None,
+        "chrome": file_signature(CHROME_BIN) if CHROME_BIN else None,
+    }
+
+def driver_preflight():
+    """
+    Путь к chromedriver для запуска или None - тогда chromedriver подберёт
+    selenium-manager. Версии сверяются, только если кэша для текущих
+    настроек нет.
+    """
+    cache = load_driver_cache()
+    driver_path = cache.get("driver_path")
+    if (cache.get("settings") == driver_settings_signature() and driver_path
+            and file_signature(driver_path) == cache.get("driver_signature")):
+        record_metric("driver_preflight_cached")
+        return driver_path
+
+    if not CHROMEDRIVER_PATH or not os.path.exists(CHROMEDRIVER_PATH):
+        return None
+    driver_major = program_major_version(CHROMEDRIVER_PATH)
+    chrome_major = program_major_version(CHROME_BIN) if CHROME_BIN else None
+    if driver_major and chrome_major and driver_major != chrome_major:
+        print(f"chromedriver {driver_major} не подходит к Chrome {chrome_major}, chromedriver подберёт selenium-manager")
+        return None
+    return CHROMEDRIVER_PATH
+
+def remember_driver(driver):
+    """Запоминаем рабочий chromedriver и версию Chrome, с которой он запустился"""
+    path = getattr(driver.service, "path", None)
+    if not path:
+        return
+    capabilities = getattr(driver, "capabilities", None) or {}
+    browser_version = capabilities.get("browserVersion")
+    driver_version = (capabilities.get("chrome") or {}).get("chromedriverVersion", "").split(" ")[0]
+    cache = {
+        "settings": driver_settings_signature(),
+        "driver_path": path,
+        "driver_signature": file_signature(path),
+        "browser_version": browser_version,
+        "driver_version": driver_version,
+    }
+    previous = load_driver_cache()
+    if previous.get("browser_version") not in (None, browser_version):
+        print(f"Chrome обновился: {previous['browser_version']} -> {browser_version}")
+    if major_version(browser_version) != major_version(driver_version):
+        print(f"Внимание: chromedriver {driver_version} при Chrome {browser_version}")
+    if previous != cache:
+        save_driver_cache(cache)
+
 def init_driver():
     """Инициализация драйвера браузера с улучшенными настройками"""
     chrome_options = Options()
+    if CHROME_BIN:
+        chrome_options.binary_location = CHROME_BIN
     
     # Улучшенные опции для стабильности
     chrome_options.add_argument("--no-sandbox")
@@ -78,25 +918,237 @@ def init_driver():
     chrome_options.add_experimental_option("excludeSwitches", ["enable-automation"])
     chrome_options.add_experimental_option('useAutomationExtension', False)
     
-    # Увеличиваем таймауты
-    chrome_options.add_argument("--page-load-strategy=normal")
     chrome_options.add_argument("--disable-web-security")
+
+    if BROWSER_PROFILE == "lean":
+        # driver.get возвращается после DOMContentLoaded, готовность проверяем сами
+        chrome_options.page_load_strategy = "eager"
+        chrome_options.add_argument(f"--window-size={WINDOW_SIZE}")
+        for flag in LEAN_CHROME_FLAGS:
+            chrome_options.add_argument(flag)
+    else:
+        chrome_options.page_load_strategy = "normal"
     
     # User-Agent для обхода детекции
-    chrome_options.add_argument("--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36")
+    chrome_options.add_argument(f"--user-agent={USER_AGENT}")
+
+    # Для движка cdp читаем сетевые события из performance-лога
+    if ENGINE == "cdp":
+        chrome_options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
     
-    driver = webdriver.Chrome(options=chrome_options)
+    driver_path = driver_preflight()
+    try:
+        service = Service(executable_path=driver_path) if driver_path else Service()
+        driver = webdriver.Chrome(service=service, options=chrome_options)
+    except WebDriverException as e:
+        if not driver_path:
+            raise
+        # Обычно Chrome обновился и старый chromedriver к нему не подходит
+        print(f"Не удалось запустить Chrome с {driver_path}, chromedriver подберёт selenium-manager: {e}")
+        clear_driver_cache()
+        driver = webdriver.Chrome(service=Service(), options=chrome_options)
+    driver = instrument_driver(driver)
+    remember_driver(driver)
     
     # Устанавливаем таймауты
     driver.set_page_load_timeout(30)  # 30 сек на загрузку страницы
-    driver.implicitly_wait(10)
+    # Неявное ожидание выключено: каждый промах find_element стоил бы до 10 сек.
+    # Ждём явно - через probe/require с таймаутом на каждый поиск
+    driver.implicitly_wait(0)
     
+    if ENGINE == "cdp":
+        enable_network_events(driver)
+    apply_tab_profile(driver)
+
     # Скрываем признаки автоматизации
     driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
     
-    driver.maximize_window()
+    if BROWSER_PROFILE != "lean":
+        driver.maximize_window()
     return driver
 
+# ===== ОЖИДАНИЯ ПО СОБЫТИЯМ =====
+# Вместо фиксированных пауз ждём конкретное состояние страницы. Прежняя длина
+# паузы остаётся верхней границей ожидания. В режиме "sleep" работают старые
+# фиксированные паузы - для сравнения задержек.
+
+def js_condition(name, script, *args):
+    """Условие ожидания на основе одного вызова execute_script"""
+    def condition(driver):
+        return driver.execute_script(script, *args)
+    condition.__name__ = name
+    return condition
+
+def xpath_exists_expr(xpath):
+    """JS-выражение: есть ли на странице элемент по XPath"""
+    return (
+        "document.evaluate(" + json.dumps(xpath) + ", document, null, "
+        "XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue !== null"
+    )
+
+page_loaded = js_condition(
+    "page_loaded",
+    "return document.readyState === 'complete';",
+)
+
+# Для eager-загрузки: DOM разобран, картинки и прочее могут ещё грузиться
+dom_ready = js_condition(
+    "dom_ready",
+    "return document.readyState !== 'loading' && document.body !== null;",
+)
+
+card_list_rendered = js_condition(
+    "card_list_rendered",
+    "return document.querySelector('[data-bot-card]') !== null"
+    " || /№\\s*\\d+/.test(document.body ? document.body.innerText : '');",
+)
+
+chat_button_present = js_condition(
+    "chat_button_present",
+    "return " + xpath_exists_expr("//*[contains(text(), 'Начать чат с клиентом')]") + ";",
+)
+
+chat_panel_mounted = js_condition(
+    "chat_panel_mounted",
+    "return document.querySelector(\"textarea, div[contenteditable='true']\") !== null || "
+    + xpath_exists_expr("//*[contains(text(), 'Начните общение с клиентом')]") + ";",
+)
+
+def message_bubble_appeared(message_text):
+    """Условие: в чате появилось сообщение, начинающееся с нашего текста"""
+    return js_condition(
+        "message_bubble_appeared",
+        """
+        const prefix = arguments[0];
+        const field = document.querySelector("textarea, div[contenteditable='true']");
+        return Array.from(document.querySelectorAll("div[dir='auto']")).some(
+            el => el !== field && !el.contains(field) && (el.innerText || '').startsWith(prefix)
+        );
+        """,
+        message_text[:40],
+    )
+
+def login_completed(driver):
+    return "loginwithpassword" not in driver.current_url
+
+def nothing_to_wait(driver):
+    """Условие-заглушка для чистых пауз: в режиме "event" не ждём вовсе"""
+    return True
+
+def element_has_value(element):
+    """Условие: в поле ввода появилось значение"""
+    return js_condition("element_has_value", "return !!arguments[0].value;", element)
+
+def element_focused(element):
+    """Условие: элемент получил фокус"""
+    return js_condition("element_focused", "return document.activeElement === arguments[0];", element)
+
+def on_neworders_page(driver):
+    return "neworders" in driver.current_url
+
+def pause(seconds):
+    """Пауза, на время которой вкладка пула отдаёт браузер другим вкладкам"""
+    tab = current_tab()
+    if tab is None:
+        time.sleep(seconds)
+        return
+    with tab.released():
+        time.sleep(seconds)
+
+def wait_until(driver, condition, timeout, legacy_sleep=None):
+    """
+    Ждём выполнения условия не дольше timeout секунд.
+    Возвращает True, если условие выполнилось. В режиме WAIT_MODE = "sleep"
+    просто спим legacy_sleep (по умолчанию timeout), как раньше.
+    Во вкладке пула браузер между проверками условия свободен для других вкладок.
+    """
+    name = getattr(condition, "__name__", "condition")
+    started = time.monotonic()
+
+    if WAIT_MODE == "sleep":
+        pause(timeout if legacy_sleep is None else legacy_sleep)
+        result = True
+    else:
+        tab = current_tab()
+        if tab is not None:
+            check = condition
+            condition = lambda d: tab.run(check, d)
+        try:
+            with tab.released() if tab is not None else contextlib.nullcontext():
+                WebDriverWait(
+                    driver,
+                    timeout,
+                    poll_frequency=WAIT_POLL_INTERVAL,
+                    ignored_exceptions=(NoSuchElementException, StaleElementReferenceException),
+                ).until(condition)
+            result = True
+        except TimeoutException:
+            result = False
+
+    elapsed = time.monotonic() - started
+    record_metric(f"wait_{name}_count")
+    record_metric(f"wait_{name}_seconds", elapsed)
+    if not result:
+        record_metric(f"wait_{name}_timeouts")
+    return result
+
+# ===== ПОИСК ЭЛЕМЕНТОВ =====
+# probe - элемент может и не найтись: None или пустой список, без исключений.
+# require - элемент обязателен: TimeoutException, если его нет за timeout.
+# Таймаут у каждого поиска свой (по умолчанию 0 - один запрос без ожидания),
+# а время, потраченное на промахи, копится в метрике locator_miss_seconds.
+
+def probe_all(driver, by, value, timeout=0, root=None, clickable=False):
+    """Все подходящие элементы; ждём не дольше timeout, пока найдётся хоть один"""
+    scope = root if root is not None else driver
+    started = time.monotonic()
+    found = []
+
+    def locate():
+        elements = scope.find_elements(by, value)
+        if clickable:
+            elements = [el for el in elements if el.is_displayed() and el.is_enabled()]
+        return elements
+
+    def element_located(d):
+        found[:] = locate()
+        return bool(found)
+
+    if not element_located(driver) and timeout > 0:
+        wait_until(driver, element_located, timeout)
+        if WAIT_MODE == "sleep":
+            element_located(driver)
+
+    if not found:
+        record_metric("locator_misses")
+        record_metric("locator_miss_seconds", time.monotonic() - started)
+    return found
+
+def probe(driver, by, value, timeout=0, root=None, clickable=False):
+    """Первый подходящий элемент или None"""
+    found = probe_all(driver, by, value, timeout=timeout, root=root, clickable=clickable)
+    return found[0] if found else None
+
+def require(driver, by, value, timeout, root=None, clickable=False):
+    """Первый подходящий элемент; TimeoutException, если его нет за timeout"""
+    element = probe(driver, by, value, timeout=timeout, root=root, clickable=clickable)
+    if element is None:
+        raise TimeoutException(f"Элемент {value} не найден за {timeout} сек")
+    return element
+
+def wait_summary():
+    """Сводка по ожиданиям с начала работы: среднее время и число таймаутов"""
+    parts = []
+    for key in sorted(METRICS):
+        if key.startswith("wait_") and key.endswith("_count"):
+            name = key[len("wait_"):-len("_count")]
+            count = METRICS[key]
+            seconds = METRICS.get(f"wait_{name}_seconds", 0)
+            timeouts = METRICS.get(f"wait_{name}_timeouts", 0)
+            parts.append(f"{name}: {count}x, ср. {seconds / count:.2f}с, таймаутов {timeouts}")
+    return "; ".join(parts)
+
+@traced("safe_get")
 def safe_get(driver, url, max_retries=3):
     """Безопасная загрузка страницы с повторными попытками"""
     for attempt in range(max_retries):
@@ -105,28 +1157,28 @@ def safe_get(driver, url, max_retries=3):
             driver.get(url)
             
             # Ждем, пока страница загрузится
-            WebDriverWait(driver, 15).until(
-                EC.presence_of_element_located((By.TAG_NAME, "body"))
-            )
+            require(driver, By.TAG_NAME, "body", 15)
             
-            # Добавляем случайную задержку для имитации человеческого поведения
-            time.sleep(random.uniform(2 / SPEED_FACTOR, 4 / SPEED_FACTOR))
+            # Ждем готовности документа (раньше - случайная пауза 2-4 сек).
+            # В lean-профиле достаточно разобранного DOM: список ждут отдельно
+            ready = dom_ready if BROWSER_PROFILE == "lean" else page_loaded
+            wait_until(driver, ready, random.uniform(2 / SPEED_FACTOR, 4 / SPEED_FACTOR))
             return True
             
         except TimeoutException:
             print(f"Таймаут при загрузке страницы (попытка {attempt + 1})")
             if attempt < max_retries - 1:
-                time.sleep(5 / SPEED_FACTOR)
+                pause(5 / SPEED_FACTOR)
                 continue
         except WebDriverException as e:
             print(f"Ошибка WebDriver при загрузке: {e}")
             if attempt < max_retries - 1:
-                time.sleep(5 / SPEED_FACTOR)
+                pause(5 / SPEED_FACTOR)
                 continue
         except Exception as e:
             print(f"Неожиданная ошибка при загрузке: {e}")
             if attempt < max_retries - 1:
-                time.sleep(5 / SPEED_FACTOR)
+                pause(5 / SPEED_FACTOR)
                 continue
     
     print("Не удалось загрузить страницу после всех попыток")
@@ -147,49 +1199,42 @@ def check_driver_health(driver):
     except Exception:
         return False
 
+@traced("login")
 def login(driver):
     """Функция авторизации напрямую через loginwithpassword"""
     try:
-        if not safe_get(driver, "https://repetit.ru/lk/loginwithpassword"):
+        if not safe_get(driver, LOGIN_URL):
             return False
 
-        wait = WebDriverWait(driver, 15)
-
         # Поле "логин"
         try:
-            login_input = wait.until(
-                EC.presence_of_element_located((By.XPATH, "//input[@placeholder='логин или номер телефона']"))
-            )
+            login_input = require(driver, By.XPATH, "//input[@placeholder='логин или номер телефона']", 15)
             login_input.clear()
             login_input.send_keys(LOGIN)
-            time.sleep(1 / SPEED_FACTOR)
+            wait_until(driver, element_has_value(login_input), 1 / SPEED_FACTOR)
         except TimeoutException:
             print("Не найдено поле логина")
             return False
 
         # Поле "пароль"
         try:
-            password_input = driver.find_element(
-                By.XPATH, "//input[@placeholder='пароль']"
-            )
+            password_input = require(driver, By.XPATH, "//input[@placeholder='пароль']", 5)
             password_input.clear()
             password_input.send_keys(PASSWORD)
-            time.sleep(1 / SPEED_FACTOR)
-        except NoSuchElementException:
+            wait_until(driver, element_has_value(password_input), 1 / SPEED_FACTOR)
+        except TimeoutException:
             print("Не найдено поле пароля")
             return False
 
         # Кнопка входа
         try:
-            login_btn = wait.until(
-                EC.element_to_be_clickable((By.XPATH, "(//div[contains(text(),'Войти')])[1]"))
-            )
+            login_btn = require(driver, By.XPATH, "(//div[contains(text(),'Войти')])[1]", 15, clickable=True)
             login_btn.click()
         except TimeoutException:
             print("Не найдена кнопка входа")
             return False
 
-        time.sleep(5 / SPEED_FACTOR)
+        wait_until(driver, login_completed, 5 / SPEED_FACTOR)
 
         if "loginwithpassword" not in driver.current_url:
             print("Авторизация выполнена успешно.")
@@ -202,189 +1247,1168 @@ def login(driver):
         print(f"Ошибка авторизации: {e}")
         return False
 
-def find_subject_requests(driver):
-    """Находим заявки по всем указанным предметам"""
-    subject_requests = []
-    found_subjects = set()
-    
-    try:
-        # Даем странице время загрузиться
-        time.sleep(3)
-        
-        # Ищем элементы для каждого предмета из списка
-        for subject in SUBJECTS_TO_SEARCH:
-            try:
-                subject_elements = driver.find_elements(
-                    By.XPATH, 
-                    f"//*[contains(text(), '{subject}')]"
-                )
-                
-                if subject_elements:
-                    print(f"Найдено элементов с '{subject}': {len(subject_elements)}")
-                    found_subjects.add(subject)
-                
-                # Для каждого элемента с предметом ищем родительскую карточку
-                for subject_element in subject_elements:
-                    try:
-                        # Ищем ближайший родительский div, который содержит всю карточку
-                        parent_card = subject_element
-                        
-                        # Поднимаемся по DOM дереву, пока не найдем элемент, который выглядит как карточка
-                        for _ in range(10):  # максимум 10 уровней вверх
-                            parent_card = parent_card.find_element(By.XPATH, "..")
-                            
-                            # Проверяем, что это похоже на карточку заявки
-                            card_html = parent_card.get_attribute('innerHTML')
-                            
-                            # Если в карточке есть признаки заявки (цена, кнопки и т.д.)
-                            if ('₽' in card_html or 'руб' in card_html) and len(card_html) > 500:
-                                if parent_card not in subject_requests:
-                                    subject_requests.append(parent_card)
-                                break
-                                
-                    except Exception as e:
-                        continue
-                        
-            except Exception as e:
-                print(f"Ошибка при поиске предмета '{subject}': {e}")
-                continue
-        
-        # Альтернативный способ - ищем через структуру CSS классов
-        if not subject_requests:
-            print("Пробуем альтернативный поиск через CSS селекторы...")
-            
-            # Ищем все div с классами, которые могут содержать карточки
-            all_divs = driver.find_elements(By.TAG_NAME, "div")
-            
-            for div in all_divs:
-                try:
-                    div_text = div.text
-                    div_html = div.get_attribute('innerHTML')
-                    
-                    # Проверяем, содержит ли div любой из наших предметов
-                    subject_found = False
-                    for subject in SUBJECTS_TO_SEARCH:
-                        if subject in div_text:
-                            subject_found = True
-                            found_subjects.add(subject)
-                            break
-                    
-                    # Если найден предмет и div похож на карточку заявки
-                    if (subject_found and 
-                        ('₽' in div_text or 'руб' in div_text) and
-                        len(div_html) > 300):
-                        
-                        if div not in subject_requests:
-                            subject_requests.append(div)
-                            
-                except Exception as e:
-                    continue
-        
-        if found_subjects:
-            print(f"Найдены предметы: {', '.join(found_subjects)}")
-        
-        print(f"Всего найдено карточек с нужными предметами: {len(subject_requests)}")
-        return subject_requests
-        
-    except Exception as e:
-        print(f"Ошибка при поиске заявок по предметам: {e}")
-        return []
+# ===== СОХРАНЕНИЕ СЕССИИ И ПЕРЕИСПОЛЬЗОВАНИЕ БРАУЗЕРА =====
 
-def get_subject_from_card(card_element):
-    """Определяет предмет из текста карточки"""
+def is_logged_in(driver):
+    """Нас не перекинуло на страницу входа"""
+    return "login" not in driver.current_url
+
+def save_session_cookies(driver):
+    """Сохраняем cookies авторизованной сессии на диск"""
     try:
-        card_text = card_element.text
-        for subject in SUBJECTS_TO_SEARCH:
-            if subject in card_text:
-                return subject
-        return "Неизвестный предмет"
-    except:
-        return "Неизвестный предмет"
+        cookies = driver.get_cookies()
+        tmp_file = COOKIES_FILE + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(cookies, f)
+        os.replace(tmp_file, COOKIES_FILE)
+    except (WebDriverException, OSError) as e:
+        print(f"Не удалось сохранить cookies: {e}")
 
-def find_chat_button(driver):
-    """Ищем div с текстом 'Начать чат с клиентом'"""
+def load_session_cookies():
     try:
-        # Ищем div с точным текстом
-        chat_div = driver.find_element(
-            By.XPATH, 
-            "//div[contains(text(), 'Начать чат с клиентом')]"
-        )
-        return chat_div
-        
-    except NoSuchElementException:
-        try:
-            # Пробуем более широкий поиск
-            chat_elements = driver.find_elements(
-                By.XPATH, 
-                "//*[contains(text(), 'чат') and contains(text(), 'клиент')]"
-            )
-            
-            for element in chat_elements:
-                if 'начать' in element.text.lower():
-                    return element
-                    
-        except Exception as e:
-            print(f"Ошибка поиска кнопки чата: {e}")
-            
-    return None
+        with open(COOKIES_FILE, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
 
-def check_if_message_sent(driver, message_text):
+def set_session_cookies(driver, cookies):
     """
-    Простая и надежная проверка - есть ли сообщения в чате
-    Если есть блок "Начните общение с клиентом" - значит чат пустой
+    Ставим cookies через CDP до первой навигации, чтобы не грузить страницу
+    домена лишний раз. Если CDP недоступен - обычным add_cookie с домена.
     """
     try:
-        # Даем время для загрузки чата
-        time.sleep(2)
-        
-        # Ищем блок "Начните общение с клиентом"
+        params = []
+        for cookie in cookies:
+            param = {key: cookie[key] for key in ("name", "value", "domain", "path", "secure", "httpOnly") if key in cookie}
+            if "expiry" in cookie:
+                param["expires"] = cookie["expiry"]
+            if cookie.get("sameSite") in ("Strict", "Lax", "None"):
+                param["sameSite"] = cookie["sameSite"]
+            params.append(param)
+        driver.execute_cdp_cmd("Network.setCookies", {"cookies": params})
+        return True
+    except WebDriverException:
+        pass
+
+    if not safe_get(driver, BASE_URL):
+        return False
+    for cookie in cookies:
+        cookie = {key: value for key, value in cookie.items() if key != "sameSite"}
         try:
-            empty_chat_element = driver.find_element(
-                By.XPATH, 
-                "//*[contains(text(), 'Начните общение с клиентом')]"
-            )
-            
-            if empty_chat_element:
-                print("Чат пустой - найден блок 'Начните общение с клиентом'")
-                return False  # Сообщения НЕ было отправлено
-                
-        except NoSuchElementException:
-            # Если блока нет, значит в чате есть сообщения
-            print("Блок 'Начните общение с клиентом' не найден - в чате есть сообщения")
-            return True  # Сообщение УЖЕ было отправлено
-            
-        except Exception as e:
-            print(f"Ошибка поиска блока пустого чата: {e}")
-            
-            # Если не можем найти блок пустого чата, используем запасной способ
-            # Ищем любые сообщения в чате
-            try:
-                messages = driver.find_elements(By.CSS_SELECTOR, "div.css-146c3p1[dir='auto']")
-                # Фильтруем служебные сообщения (время, даты и т.д.)
-                actual_messages = []
-                for msg in messages:
-                    text = msg.text.strip()
-                    # Игнорируем короткие сообщения (время), служебные тексты
-                    if (len(text) > 5 and 
-                        'Начните общение' not in text and
-                        not re.match(r'^\d{1,2}:\d{2}$', text) and  # время типа 17:24
-                        not re.match(r'^.{1,3},\s\d{1,2}\s\w+$', text)):  # дата типа "сб, 13 сентября"
-                        actual_messages.append(text)
+            driver.add_cookie(cookie)
+        except WebDriverException:
+            continue
+    return True
+
+def restore_session(driver):
+    """Восстанавливаем сохранённую сессию без формы входа"""
+    cookies = load_session_cookies()
+    if not cookies:
+        return False
+
+    print(f"Восстанавливаем сессию из {COOKIES_FILE} ({len(cookies)} cookies)")
+    if not set_session_cookies(driver, cookies):
+        return False
+    if safe_get(driver, ORDERS_LIST_URL) and is_logged_in(driver):
+        print("Сессия восстановлена, вход не нужен.")
+        return True
+
+    print("Сохранённая сессия устарела, входим заново.")
+    return False
+
+def ensure_logged_in(driver):
+    """Пробуем сохранённую сессию, иначе обычный вход с сохранением cookies"""
+    if restore_session(driver):
+        return True
+    if login(driver):
+        save_session_cookies(driver)
+        return True
+    return False
+
+def soft_reset_driver(driver):
+    """
+    Мягкий сброс без перезапуска Chrome: открываем новую вкладку, закрываем
+    остальные и возвращаемся к списку заявок. True, если браузер снова в
+    рабочем состоянии и сессия жива.
+    """
+    try:
+        old_handles = driver.window_handles
+        driver.switch_to.new_window("tab")
+        fresh_handle = driver.current_window_handle
+        for handle in old_handles:
+            driver.switch_to.window(handle)
+            driver.close()
+        driver.switch_to.window(fresh_handle)
+        apply_tab_profile(driver)
+        if not safe_get(driver, ORDERS_LIST_URL):
+            return False
+        if is_logged_in(driver):
+            return True
+        return ensure_logged_in(driver)
+    except WebDriverException as e:
+        print(f"Мягкий сброс браузера не удался: {e}")
+        return False
+
+def quit_driver(driver):
+    stop_watchdog()
+    try:
+        driver.quit()
+    except:
+        pass
+
+# ===== СОПОСТАВЛЕНИЕ ПРЕДМЕТОВ =====
+# Все предметы и их синонимы собираются в одно регулярное выражение по основам
+# слов, так что текст карточки проверяется за один проход независимо от
+# числа предметов. То же выражение передаётся в браузер для отбора карточек.
+
+# Окончания, которые отбрасываем при построении основы слова
+RUSSIAN_ENDINGS_RE = re.compile(
+    r"(иями|ями|ами|ого|его|ому|ему|ыми|ими|ой|ей|ий|ый|ая|яя|ое|ее|ие|ье|ия|ья|ию|ью"
+    r"|ах|ях|ам|ям|ом|ем|ов|ев|ую|юю|а|я|о|е|и|ы|у|ю|ь)$"
+)
+WORD_CHARS = "а-яa-z0-9"
+
+def normalize_text(text):
+    return (text or "").lower().replace("ё", "е")
+
+def word_stem(word):
+    """
+    Основа слова: без окончания, но не короче 4 букв. Для коротких слов
+    ("химия") отбрасываем только последнюю гласную, чтобы находились и
+    "химии", и "химией"; основа короче 3 букв - слово целиком.
+    """
+    stem = RUSSIAN_ENDINGS_RE.sub("", word)
+    if len(stem) >= 4:
+        return stem
+    stem = re.sub(r"[аяоеиыуюь]$", "", word)
+    return stem if len(stem) >= 3 else word
+
+def term_pattern(term):
+    """Шаблон для слова или фразы с любыми окончаниями слов"""
+    words = normalize_text(term).split()
+    return r"\s+".join(re.escape(word_stem(word)) + f"[{WORD_CHARS}]*" for word in words)
+
+# Цена в тексте карточки: сплошное число или группы по три цифры через пробел
+# или неразрывный пробел. \s захватил бы перевод строки ("Откликов: 3\n1500 ₽"
+# читалось бы как 31500), а свободные пробелы склеили бы номер с ценой
+# ("№ 5000001 1500 ₽"). Число не начинается сразу после цифры или номера.
+PRICE_RE = re.compile(r"(?<![\d№])(?<!№\s)(?:\d{1,3}(?:[ \u00a0\u202f]\d{3})+|\d+)\s*(₽|руб)")
+
+def parse_price(price):
+    """Цена в рублях из строки вида '2 000 ₽' или None"""
+    digits = re.sub(r"\D", "", str(price or ""))
+    return int(digits) if digits else None
+
+def parse_posted_minutes(text):
+    """Сколько минут назад опубликована заявка, по тексту карточки, или None"""
+    text = normalize_text(text)
+    if "только что" in text:
+        return 0
+    match = re.search(r"(\d+)\s*(мин|час|дн|день)[а-я]*\s+назад", text)
+    if not match:
+        return None
+    value = int(match.group(1))
+    unit = match.group(2)
+    if unit == "мин":
+        return value
+    if unit == "час":
+        return value * 60
+    return value * 1440
+
+def parse_responses(text):
+    """Число откликов других репетиторов, если оно указано в карточке"""
+    match = re.search(r"отклик[а-я]*:?\s*(\d+)|(\d+)\s*отклик", normalize_text(text))
+    if not match:
+        return None
+    return int(match.group(1) or match.group(2))
+
+def score_card(card):
+    """
+    Приоритет заявки: цена и свежесть с весами PRIORITY_WEIGHTS, умноженные
+    на вес предмета и уменьшенные конкуренцией (числом откликов).
+    """
+    price = parse_price(card.get("price")) or 0
+    age = parse_posted_minutes(card.get("text"))
+    if age is None:
+        age = (time.time() - card.get("seen_at", time.time())) / 60
+    responses = parse_responses(card.get("text")) or 0
+    return order_score(card.get("subject"), price, age, responses)
+
+def order_score(subject, price, age, responses):
+    """Оценка заявки по предмету, цене, возрасту в минутах и числу откликов"""
+    subject_weight = SUBJECT_CONFIG.get(subject, {}).get("weight", 1.0)
+    value = (PRIORITY_WEIGHTS["price"] * price / 1000
+             + PRIORITY_WEIGHTS["freshness"] * 0.5 ** (max(0, age) / FRESHNESS_HALF_LIFE))
+    return subject_weight * value / (1 + PRIORITY_WEIGHTS["competition"] * responses)
+
+class SubjectMatcher:
+    """Находит предметы в тексте карточки с учетом синонимов, исключений и минимальной цены"""
+
+    def __init__(self, subjects, config):
+        self.subjects = list(subjects)
+        self.config = {subject: config.get(subject, {}) for subject in self.subjects}
+        self.group_subjects = {}
+        groups = []
+        for index, subject in enumerate(self.subjects):
+            terms = [subject] + list(self.config[subject].get("aliases", []))
+            group = f"s{index}"
+            self.group_subjects[group] = subject
+            groups.append(f"(?P<{group}>" + "|".join(term_pattern(term) for term in terms) + ")")
+        self.source = f"(?<![{WORD_CHARS}])(?:" + "|".join(groups) + ")"
+        self.regex = re.compile(self.source)
+        self.excludes = {
+            subject: re.compile(f"(?<![{WORD_CHARS}])(?:" + "|".join(term_pattern(t) for t in cfg["exclude"]) + ")")
+            for subject, cfg in self.config.items() if cfg.get("exclude")
+        }
+
+    @property
+    def js_source(self):
+        """То же выражение без именованных групп - для RegExp в браузере"""
+        return re.sub(r"\(\?P<s\d+>", "(", self.source)
+
+    def mentions(self, text):
+        return self.regex.search(normalize_text(text)) is not None
+
+    def find_subjects(self, text):
+        """Предметы в порядке появления в тексте, без повторов"""
+        found = []
+        for match in self.regex.finditer(normalize_text(text)):
+            subject = self.group_subjects[match.lastgroup]
+            if subject not in found:
+                found.append(subject)
+        return found
+
+    def match_card(self, text, price=None):
+        """Первый подходящий предмет карточки или None"""
+        normalized = normalize_text(text)
+        amount = parse_price(price)
+        for subject in self.find_subjects(normalized):
+            exclude = self.excludes.get(subject)
+            if exclude and exclude.search(normalized):
+                continue
+            min_price = self.config[subject].get("min_price") or 0
+            if amount is not None and amount < min_price:
+                continue
+            return subject
+        return None
+
+subject_matcher = SubjectMatcher(SUBJECTS_TO_SEARCH, SUBJECT_CONFIG)
+
+# Общая часть скриптов извлечения: признаки карточки (цена и объём разметки,
+# как и раньше) и сборка записи. Карточка помечается атрибутом data-bot-card,
+# чтобы её можно было найти повторно по номеру заявки, а её CSS-локатор
+# запоминается для запасного поиска.
+CARD_JS_PRELUDE = r"""
+const subjectRe = new RegExp(arguments[0]);
+const mentionsSubject = (text) => subjectRe.test((text || '').toLowerCase().replace(/ё/g, 'е'));
+const looksLikeCard = (el, minHtml) => {
+    const html = el.innerHTML;
+    return (html.includes('₽') || html.includes('руб')) && html.length > minHtml;
+};
+const locatorOf = (el) => el.tagName.toLowerCase() +
+    Array.from(el.classList).map(c => '.' + CSS.escape(c)).join('');
+const buildCard = (el) => {
+    const text = el.innerText || '';
+    const idMatch = text.match(/№\s*(\d+)/);
+    const priceMatch = text.match(/(?<![\d№])(?<!№\s)(?:\d{1,3}(?:[ \u00a0\u202f]\d{3})+|\d+)\s*(₽|руб)/);
+    if (idMatch) el.setAttribute('data-bot-card', idMatch[1]);
+    return {
+        id: idMatch ? idMatch[1] : null,
+        price: priceMatch ? priceMatch[0].trim() : null,
+        text: text,
+        locator: locatorOf(el),
+        element: el,
+    };
+};
+"""
+
+# Один проход по DOM внутри браузера: от текстовых узлов с предметом поднимаемся
+# к карточке и сразу собираем всё, что нужно для обработки.
+EXTRACT_CARDS_JS = CARD_JS_PRELUDE + r"""
+const cards = [];
+const seen = new Set();
+const walker = document.createTreeWalker(document.body, NodeFilter.SHOW_TEXT);
+let node;
+while ((node = walker.nextNode())) {
+    const value = node.nodeValue;
+    if (!value || !mentionsSubject(value)) continue;
+    let el = node.parentElement;
+    for (let level = 0; level < 10 && el; level++) {
+        el = el.parentElement;
+        if (!el) break;
+        if (looksLikeCard(el, 500)) {
+            if (!seen.has(el)) {
+                seen.add(el);
+                cards.push(buildCard(el));
+            }
+            break;
+        }
+    }
+}
+return cards;
+"""
+
+# Запасной поиск: сначала по уже выученным локаторам контейнера карточки
+# (в порядке убывания попаданий), а если их нет или они не сработали -
+# от номеров заявок "№ 123" вверх до карточки. Всё внутри браузера, без
+# перебора всех div на стороне Python.
+LOCATE_CARDS_JS = CARD_JS_PRELUDE + r"""
+const locators = arguments[1];
+const pick = (elements) => {
+    const matched = elements.filter(el =>
+        looksLikeCard(el, 300) && mentionsSubject(el.innerText));
+    // Оставляем самые вложенные элементы, чтобы не взять общий контейнер списка
+    return matched.filter(el => !matched.some(other => other !== el && el.contains(other)));
+};
+for (const locator of locators) {
+    let elements;
+    try {
+        elements = Array.from(document.querySelectorAll(locator));
+    } catch (e) {
+        continue;
+    }
+    const found = pick(elements);
+    if (found.length) return {strategy: 'locator', cards: found.map(buildCard)};
+}
+const anchors = new Set();
+const walker = document.createTreeWalker(document.body, NodeFilter.SHOW_TEXT);
+let node;
+while ((node = walker.nextNode())) {
+    if (!/№\s*\d+/.test(node.nodeValue || '')) continue;
+    let el = node.parentElement;
+    for (let level = 0; level < 10 && el; level++) {
+        el = el.parentElement;
+        if (el && looksLikeCard(el, 300)) {
+            anchors.add(el);
+            break;
+        }
+    }
+}
+return {strategy: 'anchor', cards: pick(Array.from(anchors)).map(buildCard)};
+"""
+
+# Дешёвый опрос списка: отпечаток - отсортированные номера всех заявок на
+# странице (по textContent, без раскладки). Совпал с прошлым - страница не
+# изменилась и скрипт сразу выходит. Иначе собираем только карточки с новыми
+# номерами: от текста "№ 123" вверх до контейнера карточки. missing - новые
+# номера, для которых контейнер не нашёлся (тогда нужен полный снимок).
+DIFF_CARDS_JS = CARD_JS_PRELUDE + r"""
+const previous = arguments[1];
+const known = new Set(arguments[2]);
+const text = document.body ? document.body.textContent : '';
+const ids = Array.from(new Set(Array.from(text.matchAll(/№\s*(\d+)/g), m => m[1]))).sort();
+const fingerprint = ids.join(',');
+if (fingerprint === previous) return {unchanged: true, fingerprint: fingerprint, ids: ids};
+// Прошлого списка нет: карточки снимет полный снимок, здесь только номера
+if (previous === null) return {unchanged: false, fingerprint: fingerprint, ids: ids};
+const fresh = new Set(ids.filter(id => !known.has(id)));
+const cards = [];
+const located = new Set();
+if (fresh.size) {
+    const walker = document.createTreeWalker(document.body, NodeFilter.SHOW_TEXT);
+    let node;
+    while ((node = walker.nextNode())) {
+        const match = (node.nodeValue || '').match(/№\s*(\d+)/);
+        if (!match || !fresh.has(match[1]) || located.has(match[1])) continue;
+        let el = node.parentElement;
+        for (let level = 0; level < 10 && el; level++) {
+            el = el.parentElement;
+            if (el && looksLikeCard(el, 300)) {
+                located.add(match[1]);
+                if (mentionsSubject(el.innerText)) cards.push(buildCard(el));
+                break;
+            }
+        }
+    }
+}
+return {
+    unchanged: false,
+    fingerprint: fingerprint,
+    ids: ids,
+    cards: cards,
+    missing: Array.from(fresh).filter(id => !located.has(id)).length,
+};
+"""
+
+# Выученные локаторы контейнеров карточек: селектор -> число попаданий
+card_locators = {}
+
+# Состояние последнего опроса списка: отпечаток и номера заявок на странице,
+# проверен ли в этой сессии фильтр сайта
+list_snapshot = {"fingerprint": None, "ids": set(), "filter_checked": False}
+
+def make_card(element, req_id=None, subject=None, price=None, text=None):
+    """Запись карточки заявки: номер, предмет, цена, текст и ссылка на элемент"""
+    return {
+        "id": req_id,
+        "subject": subject,
+        "price": price,
+        "text": text or "",
+        "element": element,
+        "seen_at": time.time(),
+    }
+
+def cards_from_raw(raw_cards):
+    """Преобразует результат JS-скрипта в записи карточек"""
+    return [
+        make_card(
+            raw.get("element"),
+            req_id=raw.get("id"),
+            subject=subject_matcher.match_card(raw.get("text"), raw.get("price")),
+            price=raw.get("price"),
+            text=raw.get("text"),
+        )
+        for raw in raw_cards
+    ]
+
+def learn_card_locators(raw_cards):
+    """Запоминаем локаторы контейнеров, в которых нашлись настоящие карточки"""
+    hits = {}
+    for raw in raw_cards:
+        locator = raw.get("locator")
+        if locator and raw.get("id"):
+            hits[locator] = hits.get(locator, 0) + 1
+    for locator, count in hits.items():
+        card_locators[locator] = card_locators.get(locator, 0) + count
+    if hits:
+        save_card_locators(hits)
+
+def extract_cards(driver):
+    """Снимок всех карточек с нужными предметами за один вызов execute_script"""
+    raw_cards = driver.execute_script(EXTRACT_CARDS_JS, subject_matcher.js_source) or []
+    learn_card_locators(raw_cards)
+    return cards_from_raw(raw_cards)
+
+def locate_cards_fallback(driver):
+    """Запасной поиск карточек по выученным локаторам или по номерам заявок"""
+    locators = sorted(card_locators, key=card_locators.get, reverse=True)
+    result = driver.execute_script(LOCATE_CARDS_JS, subject_matcher.js_source, locators) or {}
+    strategy = result.get("strategy", "anchor")
+    raw_cards = result.get("cards") or []
+
+    record_metric("card_fallback_total")
+    record_metric(f"card_fallback_{strategy}")
+    print(f"Сработал запасной поиск карточек ({strategy}): найдено {len(raw_cards)}. "
+          f"Вероятно, изменилась вёрстка страницы. Всего срабатываний: {METRICS['card_fallback_total']}")
+
+    if strategy == "anchor":
+        learn_card_locators(raw_cards)
+    return cards_from_raw(raw_cards)
+
+def card_from_element(card_element):
+    """Строим запись карточки из живого элемента (запасной путь без JS-снимка)"""
+    text = card_element.text
+    match = re.search(r"№\s*(\d+)", text)
+    price_match = PRICE_RE.search(text)
+    price = price_match.group(0).strip() if price_match else None
+    return make_card(
+        card_element,
+        req_id=match.group(1) if match else None,
+        subject=subject_matcher.match_card(text, price),
+        price=price,
+        text=text,
+    )
+
+@traced("find_subject_requests")
+def snapshot_subject_requests(driver):
+    """Полный снимок заявок по указанным предметам; ошибки не глушит"""
+    # Ждем появления карточек на странице (не дольше 3 сек)
+    wait_until(driver, card_list_rendered, 3)
+
+    try:
+        cards = extract_cards(driver)
+        if not cards:
+            cards = locate_cards_fallback(driver)
+    except WebDriverException as e:
+        print(f"Не удалось снять карточки одним скриптом, ищем по элементам: {e}")
+        return find_subject_requests_by_elements(driver)
+
+    # Окончательная проверка предмета: исключения и минимальная цена
+    cards = [card for card in cards if card["subject"]]
+    found_subjects = {card["subject"] for card in cards}
+    if found_subjects:
+        print(f"Найдены предметы: {', '.join(found_subjects)}")
+
+    print(f"Всего найдено карточек с нужными предметами: {len(cards)}")
+    return cards
+
+def find_subject_requests(driver):
+    """Находим заявки по всем указанным предметам"""
+    try:
+        return snapshot_subject_requests(driver)
+    except Exception as e:
+        print(f"Ошибка при поиске заявок по предметам: {e}")
+        return []
+
+def reset_list_snapshot():
+    """Забываем прошлый список: следующий опрос снимет все карточки заново"""
+    list_snapshot["fingerprint"] = None
+    list_snapshot["ids"] = set()
+    list_snapshot["filter_checked"] = False
+
+def check_list_filter(ids, cards):
+    """
+    Сверка фильтра сайта с нашим сопоставлением предметов: сколько карточек
+    в списке не подошли. Предупреждаем один раз за сессию, если фильтр,
+    похоже, не сработал.
+    """
+    irrelevant = len(ids) - len(cards)
+    record_metric("list_cards_total", len(ids))
+    record_metric("list_cards_irrelevant", irrelevant)
+    if not LIST_FILTER_QUERY or list_snapshot["filter_checked"] or not ids:
+        return
+    list_snapshot["filter_checked"] = True
+    if irrelevant / len(ids) > LIST_FILTER_LEAK_SHARE:
+        record_metric("list_filter_leaks")
+        print(f"Фильтр сайта по предметам, похоже, не сработал: {irrelevant} из {len(ids)} "
+              f"карточек не подходят. Проверьте SUBJECT_FILTER_PARAM и site_filter")
+
+@traced("scan_order_list")
+def scan_order_list(driver):
+    """
+    Опрос открытого списка заявок с учётом прошлого опроса.
+    Возвращает (новые карточки с нужными предметами, номера всех заявок на
+    странице). Если список не изменился, карточек нет и DOM не обходится.
+    Первый опрос и непонятные изменения списка - полный снимок; если он не
+    удался, номеров нет (None) и прошлый список не запоминается.
+    """
+    wait_until(driver, card_list_rendered, 3)
+    try:
+        result = driver.execute_script(
+            DIFF_CARDS_JS,
+            subject_matcher.js_source,
+            list_snapshot["fingerprint"],
+            sorted(list_snapshot["ids"]),
+        ) or {}
+    except WebDriverException as e:
+        print(f"Не удалось сравнить список заявок с прошлым: {e}")
+        result = {}
+
+    ids = set(result.get("ids") or [])
+    if result.get("unchanged"):
+        record_metric("list_unchanged_total")
+        print(f"Список заявок не изменился ({len(ids)} шт.)")
+        return [], ids
+
+    if not result or list_snapshot["fingerprint"] is None or result.get("missing"):
+        # Полный снимок: первый опрос, ошибка скрипта или новая вёрстка карточек
+        try:
+            cards = snapshot_subject_requests(driver)
+        except Exception as e:
+            # Прошлый список не запоминаем: иначе следующий опрос сочтёт его
+            # неизменным и эти заявки так и не попадут в очередь
+            print(f"Ошибка при поиске заявок по предметам: {e}")
+            list_snapshot["fingerprint"] = None
+            list_snapshot["ids"] = set()
+            return [], None
+        ids |= {card["id"] for card in cards if card["id"]}
+        check_list_filter(ids, cards)
+    else:
+        raw_cards = result.get("cards") or []
+        learn_card_locators(raw_cards)
+        cards = [card for card in cards_from_raw(raw_cards) if card["subject"]]
+        check_list_filter(ids - list_snapshot["ids"], cards)
+        record_metric("list_incremental_total")
+        print(f"Новых заявок в списке: {len(ids - list_snapshot['ids'])}, "
+              f"из них с нужными предметами: {len(cards)}")
+
+    list_snapshot["fingerprint"] = result.get("fingerprint")
+    list_snapshot["ids"] = ids
+    return cards, ids
+
+def find_subject_requests_by_elements(driver):
+    """Поиск карточек через отдельные запросы к DOM (медленный запасной путь)"""
+    subject_requests = []
+    found_subjects = set()
+    
+    try:
+        # Ищем элементы для каждого предмета из списка
+        for subject in SUBJECTS_TO_SEARCH:
+            try:
+                subject_elements = probe_all(
+                    driver,
+                    By.XPATH, 
+                    f"//*[contains(text(), '{subject}')]"
+                )
                 
-                if actual_messages:
-                    print(f"В чате найдено {len(actual_messages)} сообщений")
-                    return True  # Есть сообщения
-                else:
-                    print("В чате нет сообщений")
-                    return False  # Нет сообщений
-                    
-            except Exception as e2:
-                print(f"Ошибка запасного способа: {e2}")
-                return False  # В случае ошибки считаем, что сообщения нет
+                if subject_elements:
+                    print(f"Найдено элементов с '{subject}': {len(subject_elements)}")
+                    found_subjects.add(subject)
+                
+                # Для каждого элемента с предметом ищем родительскую карточку
+                for subject_element in subject_elements:
+                    try:
+                        # Ищем ближайший родительский div, который содержит всю карточку
+                        parent_card = subject_element
+                        
+                        # Поднимаемся по DOM дереву, пока не найдем элемент, который выглядит как карточка
+                        for _ in range(10):  # максимум 10 уровней вверх
+                            parent_card = probe(driver, By.XPATH, "..", root=parent_card)
+                            if parent_card is None:
+                                break
+                            
+                            # Проверяем, что это похоже на карточку заявки
+                            card_html = parent_card.get_attribute('innerHTML')
+                            
+                            # Если в карточке есть признаки заявки (цена, кнопки и т.д.)
+                            if ('₽' in card_html or 'руб' in card_html) and len(card_html) > 500:
+                                if parent_card not in subject_requests:
+                                    subject_requests.append(parent_card)
+                                break
+                                
+                    except Exception as e:
+                        continue
+                        
+            except Exception as e:
+                print(f"Ошибка при поиске предмета '{subject}': {e}")
+                continue
+        
+        # Альтернативный способ - только по выученным локаторам карточек,
+        # без перебора всех div на странице
+        if not subject_requests and card_locators:
+            print("Пробуем альтернативный поиск по выученным локаторам карточек...")
+            record_metric("card_fallback_total")
+            record_metric("card_fallback_elements")
+
+            for locator in sorted(card_locators, key=card_locators.get, reverse=True):
+                try:
+                    for card in probe_all(driver, By.CSS_SELECTOR, locator):
+                        card_text = card.text
+                        subject = subject_matcher.match_card(card_text)
+                        if subject and ('₽' in card_text or 'руб' in card_text):
+                            found_subjects.add(subject)
+                            if card not in subject_requests:
+                                subject_requests.append(card)
+                except Exception as e:
+                    continue
+                if subject_requests:
+                    break
+        
+        if found_subjects:
+            print(f"Найдены предметы: {', '.join(found_subjects)}")
+        
+        print(f"Всего найдено карточек с нужными предметами: {len(subject_requests)}")
+        return [card_from_element(card) for card in subject_requests]
         
     except Exception as e:
-        print(f"Общая ошибка при проверке чата: {e}")
+        print(f"Ошибка при поиске заявок по предметам: {e}")
+        return []
+
+def get_subject_from_card(card):
+    """Определяет предмет из текста карточки"""
+    try:
+        if isinstance(card, dict):
+            return card.get("subject") or "Неизвестный предмет"
+        return subject_matcher.match_card(card.text) or "Неизвестный предмет"
+    except:
+        return "Неизвестный предмет"
+
+# ===== СПИСОК ЗАЯВОК ПО HTTP (LIST_BACKEND = "http") =====
+# Для обнаружения новых заявок браузер не нужен: список забираем обычным
+# HTTP-запросом с cookies сессии, которую браузер уже авторизовал, и строим
+# те же записи карточек, что и find_subject_requests (только без элемента).
+# Браузер открывает список, лишь когда есть что обрабатывать.
+
+ORDER_KEYS_RE = re.compile(r"subject|price|order|lesson|student", re.IGNORECASE)
+
+http_pool = None
+
+def get_http_pool():
+    global http_pool
+    if http_pool is None:
+        http_pool = urllib3.PoolManager(
+            num_pools=2,
+            maxsize=2,
+            timeout=urllib3.Timeout(connect=5, read=15),
+            retries=urllib3.Retry(total=2, backoff_factor=0.5, redirect=3),
+        )
+    return http_pool
+
+def iter_order_dicts(data):
+    """Словари из JSON, похожие на заявку: числовой id и поля заявки"""
+    if isinstance(data, dict):
+        order_id = data.get("id", data.get("orderId", data.get("order_id")))
+        if (isinstance(order_id, (int, str)) and str(order_id).isdigit()
+                and any(ORDER_KEYS_RE.search(str(key)) for key in data)):
+            yield data
+        for value in data.values():
+            yield from iter_order_dicts(value)
+    elif isinstance(data, list):
+        for value in data:
+            yield from iter_order_dicts(value)
+
+def card_from_order_json(order):
+    """Запись карточки из JSON-объекта заявки"""
+    req_id = str(order.get("id", order.get("orderId", order.get("order_id"))))
+    text = json.dumps(order, ensure_ascii=False)
+    price = next(
+        (str(value) for key, value in order.items()
+         if "price" in str(key).lower() and isinstance(value, (int, float, str))),
+        None,
+    )
+    subject = subject_matcher.match_card(text, price)
+    return make_card(None, req_id=req_id, subject=subject, price=price, text=text)
+
+class TextCollector(HTMLParser):
+    """Собирает видимый текст HTML-страницы"""
+
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+        self.skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ("script", "style"):
+            self.skip += 1
+
+    def handle_endtag(self, tag):
+        if tag in ("script", "style") and self.skip:
+            self.skip -= 1
+
+    def handle_data(self, data):
+        if not self.skip and data.strip():
+            self.parts.append(data.strip())
+
+def cards_from_html(html):
+    """
+    Карточки из HTML: текст между соседними номерами заявок '№ 123'.
+    None, если заявок в разметке нет (например, оболочка SPA без данных) -
+    такой ответ ничего не говорит о списке.
+    """
+    collector = TextCollector()
+    collector.feed(html)
+    text = "\n".join(collector.parts)
+    cards = []
+    for match in re.finditer(r"№\s*(\d+)(.*?)(?=№\s*\d+|\Z)", text, re.DOTALL):
+        card_text = match.group(0)
+        price_match = PRICE_RE.search(card_text)
+        if price_match:
+            cards.append(make_card(
+                None,
+                req_id=match.group(1),
+                subject=subject_matcher.match_card(card_text, price_match.group(0)),
+                price=price_match.group(0).strip(),
+                text=card_text,
+            ))
+    return cards or None
+
+def http_cookie_header():
+    """Cookie для запросов из сохранённой сессии браузера"""
+    return "; ".join(f"{c['name']}={c['value']}" for c in load_session_cookies())
+
+def fetch_cards_http():
+    """
+    Загружает список заявок без браузера. Возвращает карточки с нужными
+    предметами или None, если сессия не подошла или ответ не разобрать -
+    тогда список загружается в браузере.
+    """
+    cookie = http_cookie_header()
+    if not cookie:
+        return None
+
+    try:
+        response = get_http_pool().request("GET", LIST_FETCH_URL or ORDERS_LIST_URL, headers={
+            "Cookie": cookie,
+            "User-Agent": USER_AGENT,
+            "Accept": "application/json, text/html;q=0.9",
+        })
+    except urllib3.exceptions.HTTPError as e:
+        print(f"Ошибка HTTP-запроса списка заявок: {e}")
+        return None
+
+    final_url = response.geturl() or LIST_FETCH_URL or ORDERS_LIST_URL
+    if response.status != 200 or "login" in final_url:
+        print(f"HTTP-список заявок недоступен (код {response.status}, {final_url})")
+        return None
+
+    body = response.data.decode("utf-8", errors="replace")
+    if "json" in response.headers.get("Content-Type", ""):
+        try:
+            cards = [card_from_order_json(order) for order in iter_order_dicts(json.loads(body))]
+        except ValueError:
+            return None
+    else:
+        cards = cards_from_html(body)
+
+    # Ни одной заявки не разобрали: пустой результат считался бы полным списком,
+    # и заявки из очереди ушли бы как пропавшие с сайта
+    if not cards:
+        print("HTTP: в ответе не нашлось заявок, список загрузим в браузере")
+        return None
+
+    cards = [card for card in cards if card["subject"]]
+    print(f"HTTP: найдено карточек с нужными предметами: {len(cards)}")
+    return cards
+
+def find_chat_button(driver):
+    """Ищем div с текстом 'Начать чат с клиентом'"""
+    try:
+        # Ищем div с точным текстом (появление кнопки уже дождались)
+        chat_div = probe(driver, By.XPATH, "//div[contains(text(), 'Начать чат с клиентом')]")
+        if chat_div is not None:
+            return chat_div
+
+        # Пробуем более широкий поиск
+        chat_elements = probe_all(
+            driver,
+            By.XPATH, 
+            "//*[contains(text(), 'чат') and contains(text(), 'клиент')]"
+        )
+        
+        for element in chat_elements:
+            if 'начать' in element.text.lower():
+                return element
+                
+    except WebDriverException as e:
+        print(f"Ошибка поиска кнопки чата: {e}")
+            
+    return None
+
+# Состояние чата одним скриптом. Пустой блок "Начните общение с клиентом" -
+# чат пуст. Иначе смотрим сообщения рядом с полем ввода (без времени и дат):
+# начинается с одного из наших текстов - наше, иначе чужие. null - чат ещё
+# не показал ни того, ни другого, ждём дальше.
+CHAT_STATE_JS = r"""
+const prefixes = arguments[0];
+const emptyMarker = document.evaluate(
+    "//*[contains(text(), 'Начните общение с клиентом')]", document, null,
+    XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+if (emptyMarker) return 'empty';
+const field = document.querySelector("textarea, div[contenteditable='true']");
+if (!field) return null;
+let scope = field.parentElement;
+while (scope && scope !== document.body && !scope.querySelector("div[dir='auto']")) {
+    scope = scope.parentElement;
+}
+if (!scope) return null;
+const texts = Array.from(scope.querySelectorAll("div[dir='auto']"))
+    .filter(el => el !== field && !el.contains(field) && !el.querySelector("div[dir='auto']"))
+    .map(el => (el.innerText || '').trim())
+    .filter(text => text.length > 5
+        && !/^\d{1,2}:\d{2}$/.test(text)
+        && !/^.{1,3},\s\d{1,2}\s\S+$/.test(text));
+if (!texts.length) return null;
+return texts.some(text => prefixes.some(prefix => text.startsWith(prefix))) ? 'ours' : 'others';
+"""
+
+def message_prefixes(message_text):
+    """Начала наших сообщений: текущий текст и недавно отправленные"""
+    texts = [message_text] + init_db().sent_texts()
+    return sorted({text[:40] for text in texts if text})
+
+@traced("check_chat_state")
+def check_chat_state(driver, req_id, message_text):
+    """
+    Состояние чата заявки: CHAT_EMPTY, CHAT_OURS, CHAT_OTHERS или CHAT_UNKNOWN.
+    Если отправка записана в базе, в DOM не смотрим. Иначе один скрипт с
+    коротким ожиданием; если чат так и не показал ни сообщений, ни пустого
+    блока, состояние неизвестно (CHAT_UNKNOWN) - заявку повторит очередь.
+    """
+    if req_id and init_db().was_sent(req_id):
+        print("Отправка уже записана в базе")
+        return CHAT_OURS
+
+    condition = js_condition("chat_state_known", CHAT_STATE_JS, message_prefixes(message_text))
+    seen = {}
+
+    def chat_state_known(d):
+        seen["state"] = condition(d)
+        return seen["state"]
+
+    try:
+        wait_until(driver, chat_state_known, CHAT_CHECK_TIMEOUT)
+        state = seen.get("state") or condition(driver)
+    except WebDriverException as e:
+        print(f"Ошибка проверки чата: {e}")
+        return CHAT_UNKNOWN
+
+    if state == CHAT_EMPTY:
+        print("Чат пустой - найден блок 'Начните общение с клиентом'")
+    elif state == CHAT_OURS:
+        print("В чате уже есть наше сообщение")
+    elif state == CHAT_OTHERS:
+        print("В чате есть чужие сообщения")
+    else:
+        print(f"Чат не загрузился за {CHAT_CHECK_TIMEOUT} сек")
+        state = CHAT_UNKNOWN
+    return state
+
+# Вставка текста целиком с одним событием input. Для textarea/input значение
+# ставится через нативный сеттер, чтобы React увидел изменение, для
+# contenteditable - через insertText. Возвращает итоговый текст поля.
+INSERT_TEXT_JS = r"""
+const field = arguments[0];
+const text = arguments[1];
+field.focus();
+if (field.isContentEditable) {
+    document.execCommand('selectAll', false, null);
+    document.execCommand('insertText', false, text);
+    return field.innerText;
+}
+const proto = field.tagName === 'TEXTAREA' ? HTMLTextAreaElement.prototype : HTMLInputElement.prototype;
+Object.getOwnPropertyDescriptor(proto, 'value').set.call(field, text);
+field.dispatchEvent(new Event('input', {bubbles: true}));
+return field.value;
+"""
+
+def type_by_chars(input_field, text):
+    """Ввод по одному символу с паузами, как человек (самый медленный)"""
+    for char in text:
+        input_field.send_keys(char)
+        pause(random.uniform(0.25 / TYPING_SPEED_FACTOR, 0.5 / TYPING_SPEED_FACTOR))
+
+def type_by_chunks(input_field, text):
+    """Ввод кусками по INPUT_CHUNK_SIZE символов - один запрос к драйверу на кусок"""
+    for start in range(0, len(text), INPUT_CHUNK_SIZE):
+        input_field.send_keys(text[start:start + INPUT_CHUNK_SIZE])
+        pause(random.uniform(0.25 / TYPING_SPEED_FACTOR, 0.5 / TYPING_SPEED_FACTOR))
+
+def type_message(driver, input_field, text):
+    """Вводит сообщение в поле способом из INPUT_MODE: char, chunk или insert"""
+    if INPUT_MODE == "char":
+        type_by_chars(input_field, text)
+    elif INPUT_MODE == "chunk":
+        type_by_chunks(input_field, text)
+    else:
+        inserted = driver.execute_script(INSERT_TEXT_JS, input_field, text) or ""
+        if inserted.strip() != text.strip():
+            print("Вставка текста не сработала, вводим кусками")
+            input_field.clear()
+            type_by_chunks(input_field, text)
+
+FIELD_TEXT_JS = "return arguments[0].value !== undefined ? arguments[0].value : arguments[0].innerText;"
+
+CARD_BY_ID_JS = "return document.querySelector('[data-bot-card=\"' + arguments[0] + '\"]');"
+
+class BoundElement:
+    """
+    Ссылка на элемент, привязанная к заявке. Если SPA перерисовала DOM и
+    ссылка устарела (StaleElementReferenceException), элемент находится
+    заново функцией locate - без перезагрузки страницы, не больше
+    STALE_RETRIES раз.
+    """
+
+    def __init__(self, req_id, name, locate, element=None):
+        self.req_id = req_id
+        self.name = name
+        self.locate = locate
+        self.element = element
+        self.relocations = 0
+
+    def get(self):
+        if self.element is None:
+            self.element = self.locate()
+            if self.element is None:
+                raise NoSuchElementException(f"Элемент '{self.name}' заявки {self.req_id} не найден после перерисовки")
+        return self.element
+
+    def run(self, action):
+        """Выполняет action(element), находя элемент заново, если он устарел"""
+        for attempt in range(STALE_RETRIES + 1):
+            try:
+                return action(self.get())
+            except StaleElementReferenceException:
+                if attempt == STALE_RETRIES:
+                    raise
+                record_metric("stale_element_retries")
+                print(f"Элемент '{self.name}' заявки {self.req_id} устарел после перерисовки, ищем заново "
+                      f"({attempt + 1}/{STALE_RETRIES})")
+                self.element = None
+                self.relocations += 1
+
+def locate_card_element(driver, req_id):
+    """Карточка заявки на открытой странице: по метке data-bot-card, иначе новым снимком"""
+    element = driver.execute_script(CARD_BY_ID_JS, req_id)
+    if element is None:
+        card = find_card_by_id(extract_cards(driver), req_id)
+        element = card["element"] if card else None
+    return element
+
+def locate_input_field(driver):
+    """Поле ввода сообщения в открытом чате"""
+    # Панель чата уже смонтирована, долго ждать textarea незачем
+    input_field = probe(driver, By.TAG_NAME, "textarea", 2, clickable=True)
+    if input_field is None:
+        # Пробуем другие селекторы
+        input_fields = probe_all(driver, By.CSS_SELECTOR, "input[type='text'], textarea, div[contenteditable='true']")
+        if input_fields:
+            input_field = input_fields[-1]  # Берем последнее поле
+    return input_field
+
+def finish_sent_order(req_id, subject, processed):
+    """
+    Заявка, которую прервали после отправки: сообщение уже ушло, поэтому
+    браузер не нужен - только отмечаем заявку обработанной. True, если так.
+    """
+    stage = order_stage(req_id)
+    if stage not in (STAGE_SENT, STAGE_CONFIRMED):
         return False
+    print(f"Заявка {req_id} уже отправлена до перезапуска (этап {stage}), отмечаем обработанной")
+    save_processed_request(req_id, subject=subject, outcome=OUTCOME_SENT)
+    processed.add(req_id)
+    log_event("order_resumed", req_id=req_id, subject=subject, stage=stage)
+    return True
+
+def process_card(driver, request_card, processed):
+    """
+    Обрабатывает одну карточку заявки: открывает чат и отправляет сообщение.
+    Этапы (чат открыт, текст набран, отправлено, подтверждено) сразу пишутся
+    в базу; после падения продолжаем с последнего записанного этапа.
+    """
+    req_id = extract_request_id(request_card)
+
+    # Определяем предмет заявки
+    subject = get_subject_from_card(request_card)
+
+    if finish_sent_order(req_id, request_card.get("subject"), processed):
+        return True
+    resumed_stage = order_stage(req_id)
+    # Заявки из прошлых опросов приходят пересобранными карточками со свежим
+    # seen_at; время до ответа считаем от первого появления в списке
+    seen_at = request_card["seen_at"]
+    if req_id:
+        init_db().add_first_seen([request_card])
+        seen_at = init_db().first_seen_at(req_id) or seen_at
+
+    print(f"Обрабатываем заявку по предмету '{subject}' #{req_id}")
+    started = time.monotonic()
+
+    # Ссылки на элементы переживают перерисовку списка и чата
+    card = BoundElement(req_id, "карточка", lambda: locate_card_element(driver, req_id),
+                        element=request_card["element"])
+
+    try:
+        with span("open_card", req_id):
+            # Скроллим к карточке (прокрутка синхронная, ждать нечего)
+            card.run(lambda el: driver.execute_script("arguments[0].scrollIntoView(true);", el))
+            wait_until(driver, nothing_to_wait, random.uniform(0.5  / SPEED_FACTOR, 1 / SPEED_FACTOR))
+            
+            # Кликаем на карточку и ждем появления кнопки чата
+            card.run(lambda el: driver.execute_script("arguments[0].click();", el))
+            request_card["element"] = card.element
+            wait_until(driver, chat_button_present, random.uniform(1 / SPEED_FACTOR, 2 / SPEED_FACTOR))
+            
+            # Ищем div "Начать чат с клиентом"
+            chat_div = find_chat_button(driver)
+        
+        if chat_div:
+            print("Найден элемент 'Начать чат с клиентом'")
+            chat_button = BoundElement(req_id, "кнопка чата", lambda: find_chat_button(driver), element=chat_div)
+            with span("open_chat", req_id):
+                chat_button.run(lambda el: driver.execute_script("arguments[0].click();", el))
+                wait_until(driver, chat_panel_mounted, random.uniform(1 / SPEED_FACTOR, 2 / SPEED_FACTOR))
+            advance_stage(req_id, STAGE_CHAT_OPENED)
+            
+            # Проверяем, было ли уже отправлено сообщение
+            chat_state = check_chat_state(driver, req_id, MESSAGE)
+            
+            if chat_state == CHAT_EMPTY:
+                print("Новая заявка найдена, отправляем сообщение.")
+                outcome = OUTCOME_ERROR
+                error = "send"
+                
+                try:
+                    # Пытаемся найти поле для ввода разными способами
+                    input_field = locate_input_field(driver)
+                    
+                    if input_field:
+                        field = BoundElement(req_id, "поле ввода", lambda: locate_input_field(driver),
+                                             element=input_field)
+
+                        def field_text(el):
+                            return (driver.execute_script(FIELD_TEXT_JS, el) or "").strip()
+
+                        def retype(el):
+                            # Перерисованное поле могло потерять часть текста - набираем заново
+                            el.clear()
+                            type_message(driver, el, MESSAGE)
+
+                        def press_enter(el):
+                            if field.relocations and field_text(el) != MESSAGE.strip():
+                                retype(el)
+                            el.send_keys(Keys.ENTER)
+
+                        # Кликаем на поле и вводим текст
+                        field.run(lambda el: el.click())
+                        wait_until(driver, element_focused(field.get()), 1)
+
+                        # Текст, набранный до перезапуска, мог сохраниться черновиком
+                        if resumed_stage == STAGE_TYPED and field.run(field_text) == MESSAGE.strip():
+                            print("Текст уже набран до перезапуска, сразу отправляем")
+                        else:
+                            # Вводим текст выбранным способом (INPUT_MODE)
+                            with span("type_message", req_id):
+                                field.run(retype)
+                            advance_stage(req_id, STAGE_TYPED)
+                        
+                        wait_until(driver, nothing_to_wait, 1)
+                        # Отправляем сообщение
+                        if CAN_SEND_MESSAGE:
+                            # Общий для всех вкладок лимит частоты отправки
+                            send_rate_limiter.wait()
+                            with span("send", req_id):
+                                field.run(press_enter)
+                                # Запись об отправке - до всего остального, чтобы не написать дважды
+                                init_db().record_sent(req_id, MESSAGE)
+                                appeared = wait_until(driver, message_bubble_appeared(MESSAGE), 5, legacy_sleep=0)
+                            if appeared:
+                                print("Сообщение отправлено.")
+                                advance_stage(req_id, STAGE_CONFIRMED)
+                            else:
+                                print("Сообщение отправлено, но не появилось в чате за 5 сек.")
+                            outcome = OUTCOME_SENT
+                            observe("time_to_reply_seconds", time.time() - seen_at)
+                            
+                        else:
+                            print("Отправка сообщений отключена.")
+                            outcome = OUTCOME_SKIPPED
+                            
+                    else:
+                        print("Поле для ввода сообщения не найдено.")
+                        
+                except Exception as send_e:
+                    print(f"Ошибка отправки сообщения: {send_e}")
+                    
+            elif chat_state == CHAT_OURS:
+                print("Сообщение уже было отправлено.")
+                outcome = OUTCOME_ALREADY_SENT
+            elif chat_state == CHAT_UNKNOWN:
+                # Медленно загружающийся пустой чат - не повод терять заявку
+                print("Состояние чата неизвестно, вернёмся к заявке позже.")
+                outcome = OUTCOME_ERROR
+                error = "chat-unknown"
+            else:
+                print("В чате уже идёт переписка, не пишем.")
+                outcome = OUTCOME_CHAT_BUSY
+                
+        else:
+            print("Элемент 'Начать чат с клиентом' не найден.")
+            outcome = OUTCOME_NO_CHAT
+        
+        duration = time.monotonic() - started
+        if outcome == OUTCOME_ERROR:
+            # Сообщение не ушло - заявку не отмечаем, её повторит очередь
+            log_event("order_failed", req_id=req_id, subject=subject, error=error, duration=round(duration, 3))
+            return False
+
+        # Отмечаем заявку как обработанную
+        save_processed_request(
+            req_id,
+            subject=request_card.get("subject"),
+            outcome=outcome,
+            duration=duration,
+        )
+        processed.add(req_id)
+        init_db().add_event(req_id, "processed", detail=outcome, seconds=round(duration, 3))
+        observe("order_seconds", duration, outcome=outcome)
+        log_event("order_processed", req_id=req_id, subject=subject, outcome=outcome, duration=round(duration, 3))
+        
+        return True  # Успешно обработали заявку
+        
+    except Exception as e:
+        print(f"Ошибка при обработке заявки {req_id}: {e}")
+        log_event("order_failed", req_id=req_id, subject=subject, error=str(e))
+        return False  # Ошибка при обработке
 
 def process_single_request(driver, processed):
     """Обрабатывает одну заявку по любому из указанных предметов"""
@@ -407,92 +2431,7 @@ def process_single_request(driver, processed):
                 print(f"Заявка {req_id} уже обработана, пропускаем")
                 continue
             
-            # Определяем предмет заявки
-            subject = get_subject_from_card(request_card)
-            
-            # Нашли необработанную заявку - обрабатываем её
-            print(f"Обрабатываем заявку по предмету '{subject}' #{req_id}")
-            
-            try:
-                # Скроллим к карточке
-                driver.execute_script("arguments[0].scrollIntoView(true);", request_card)
-                time.sleep(random.uniform(0.5  / SPEED_FACTOR, 1 / SPEED_FACTOR))
-                
-                # Кликаем на карточку
-                driver.execute_script("arguments[0].click();", request_card)
-                time.sleep(random.uniform(1 / SPEED_FACTOR, 2 / SPEED_FACTOR))
-                
-                # Ищем div "Начать чат с клиентом"
-                chat_div = find_chat_button(driver)
-                
-                if chat_div:
-                    print("Найден элемент 'Начать чат с клиентом'")
-                    driver.execute_script("arguments[0].click();", chat_div)
-                    time.sleep(random.uniform(1 / SPEED_FACTOR, 2 / SPEED_FACTOR))
-                    
-                    # Проверяем, было ли уже отправлено сообщение
-                    already_sent = check_if_message_sent(driver, MESSAGE)
-                    
-                    if not already_sent:
-                        print("Новая заявка найдена, отправляем сообщение.")
-                        
-                        try:
-                            input_field = None
-                            
-                            # Пытаемся найти поле для ввода разными способами
-                            wait = WebDriverWait(driver, 10)
-                            
-                            try:
-                                input_field = wait.until(
-                                    EC.element_to_be_clickable((By.TAG_NAME, "textarea"))
-                                )
-                            except TimeoutException:
-                                # Пробуем другие селекторы
-                                input_fields = driver.find_elements(By.CSS_SELECTOR, "input[type='text'], textarea, div[contenteditable='true']")
-                                if input_fields:
-                                    input_field = input_fields[-1]  # Берем последнее поле
-                            
-                            if input_field:
-                                # Кликаем на поле и вводим текст
-                                input_field.click()
-                                time.sleep(1)
-                                input_field.clear()
-                                
-                                # Вводим текст по символам для имитации человека
-                                for char in MESSAGE:
-                                    input_field.send_keys(char)
-                                    time.sleep(random.uniform(0.25 / TYPING_SPEED_FACTOR, 0.5 / TYPING_SPEED_FACTOR))
-                                
-                                time.sleep(1)
-                                # Отправляем сообщение
-                                if CAN_SEND_MESSAGE:
-                                    input_field.send_keys(Keys.ENTER)
-                                    print("Сообщение отправлено.")
-                                    
-                                else:
-                                    print("Отправка сообщений отключена.")
-                                    
-                            else:
-                                print("Поле для ввода сообщения не найдено.")
-                                
-                        except Exception as send_e:
-                            print(f"Ошибка отправки сообщения: {send_e}")
-                            
-                    else:
-                        print("Сообщение уже было отправлено.")
-                        
-                else:
-                    print("Элемент 'Начать чат с клиентом' не найден.")
-                
-                # Отмечаем заявку как обработанную
-                save_processed_request(req_id)
-                processed.add(req_id)
-                
-                return req_id, True  # Успешно обработали заявку
-                
-            except Exception as e:
-                print(f"Ошибка при обработке заявки {req_id}: {e}")
-                return req_id, False  # Ошибка при обработке
+            return req_id, process_card(driver, request_card, processed)
         
         # Все найденные заявки уже обработаны
         return None, True
@@ -501,43 +2440,224 @@ def process_single_request(driver, processed):
         print(f"Ошибка в process_single_request: {e}")
         return None, False
 
+def is_card_attached(driver, request_card):
+    """Проверяем, что элемент карточки всё ещё находится в DOM"""
+    try:
+        return bool(driver.execute_script("return arguments[0].isConnected;", request_card["element"]))
+    except WebDriverException:
+        return False
+
+def find_card_by_id(cards, req_id):
+    """Ищем карточку с нужным номером в снимке"""
+    return next((card for card in cards if extract_request_id(card) == req_id), None)
+
+def resolve_card(driver, request_card):
+    """
+    Возвращает актуальную карточку заявки из списка.
+    Сначала используем уже снятый элемент, затем снимаем карточки заново без
+    перезагрузки, затем возвращаемся назад к списку, и только если список
+    устарел - перезагружаем страницу заявок.
+    """
+    req_id = extract_request_id(request_card)
+
+    has_element = request_card["element"] is not None
+
+    if has_element and "neworders" in driver.current_url and is_card_attached(driver, request_card):
+        return request_card
+
+    if has_element and "neworders" not in driver.current_url:
+        try:
+            driver.back()
+            wait_until(driver, on_neworders_page, 5, legacy_sleep=0)
+        except WebDriverException:
+            pass
+
+    if "neworders" in driver.current_url:
+        card = find_card_by_id(extract_cards(driver), req_id)
+        if card:
+            return card
+
+    print(f"Список заявок устарел, перезагружаем страницу для заявки {req_id}")
+    if not safe_get(driver, ORDERS_LIST_URL):
+        return None
+    return find_card_by_id(find_subject_requests(driver), req_id)
+
+def record_order_failure(req_id, subject=None):
+    """
+    Учитываем неудачную попытку. Пока попытки не исчерпаны, заявка остаётся в
+    очереди на повтор, потом она отмечается обработанной с итогом error.
+    """
+    attempts = store.mark_order_failed(req_id)
+    store.add_event(req_id, "failed", detail=str(attempts))
+    if attempts >= MAX_ORDER_ATTEMPTS:
+        print(f"Заявка {req_id}: попытки исчерпаны ({attempts}), больше не повторяем")
+        save_processed_request(req_id, subject=subject, outcome=OUTCOME_ERROR)
+    else:
+        print(f"Заявка {req_id}: попытка {attempts} из {MAX_ORDER_ATTEMPTS} не удалась, повторим")
+
+def check_requests_batch(driver, processed, max_requests, reload=True):
+    """
+    Пакетная обработка: один раз загружаем список, ставим в очередь все
+    необработанные заявки и обрабатываем их по очереди без перезагрузки.
+    С reload=False используем уже открытый список, если мы на нём.
+    """
+    cards = None
+    if LIST_BACKEND == "http":
+        cards = fetch_cards_http()
+        if cards is None:
+            print("Загружаем список заявок в браузере")
+        else:
+            listed = {extract_request_id(card) for card in cards}
+
+    if cards is None:
+        if (reload or "neworders" not in driver.current_url) and not safe_get(driver, ORDERS_LIST_URL):
+            print("Не удалось загрузить страницу заявок")
+            return None
+        # Только новые карточки; listed - все номера, что сейчас есть в списке
+        cards, listed = scan_order_list(driver)
+        if listed is None:
+            # Без списка нельзя отличить пропавшие заявки от несчитанных
+            print("Не удалось снять список заявок")
+            return None
+
+    # Новые заявки попадают в очередь с оценкой приоритета, уже известные - обновляют её
+    cards_by_id = {}
+    for request_card in cards:
+        req_id = extract_request_id(request_card)
+        if not req_id:
+            print("Не удалось извлечь номер заявки, пропускаем")
+            continue
+        if req_id not in processed:
+            cards_by_id.setdefault(req_id, request_card)
+    if cards_by_id:
+        store.enqueue_cards(list(cards_by_id.values()))
+
+    if not store.next_orders(1):
+        print("Все доступные заявки по указанным предметам обработаны.")
+        return 0
+
+    # С пулом вкладок эта вкладка только сканирует, а заявки отвечают другие
+    if tab_pool is not None:
+        return tab_pool.dispatch(max_requests, listed=listed)
+
+    # Всегда берём верх очереди: он может меняться по ходу обработки
+    processed_in_session = 0
+    tried = set()
+    while processed_in_session < max_requests:
+        top = store.next_orders(1, exclude=tried)
+        if not top:
+            break
+        req_id, subject = top[0]
+        tried.add(req_id)
+
+        if not driver_healthy(driver):
+            print("Драйвер потерял соединение во время обработки")
+            return None
+        if recycle_pending():
+            print("Браузер будет перезапущен, остальные заявки - после перезапуска")
+            break
+
+        if finish_sent_order(req_id, subject, processed):
+            store.mark_order(req_id, ORDER_DONE)
+            continue
+
+        if req_id not in listed:
+            # Заявки из прошлых циклов, которой нет в свежем списке, больше нет на сайте
+            print(f"Заявки {req_id} больше нет в списке, убираем из очереди")
+            store.mark_order(req_id, ORDER_GONE)
+            continue
+        # Карточки из прошлых опросов resolve_card найдёт на странице по номеру
+        request_card = cards_by_id.get(req_id) or make_card(None, req_id=req_id, subject=subject)
+
+        request_card = resolve_card(driver, request_card)
+        if request_card is None:
+            print(f"Карточка заявки {req_id} больше не найдена, пропускаем")
+            store.mark_order(req_id, ORDER_GONE)
+            continue
+
+        store.mark_order(req_id, ORDER_IN_PROGRESS)
+        if process_card(driver, request_card, processed):
+            store.mark_order(req_id, ORDER_DONE)
+            processed_in_session += 1
+            print(f"Заявка {req_id} успешно обработана. Обработано в этой сессии: {processed_in_session}")
+            
+            # Небольшая пауза между заявками
+            pause(random.uniform(3, 7))
+        else:
+            print(f"Ошибка при обработке заявки {req_id}")
+            record_order_failure(req_id, request_card.get("subject"))
+            # При ошибке тоже делаем паузу
+            pause(5 / SPEED_FACTOR)
+
+    return processed_in_session
+
+def check_requests_one_by_one(driver, processed, max_requests):
+    """Обработка по одной заявке с перезагрузкой списка перед каждой"""
+    processed_in_session = 0
+    
+    while processed_in_session < max_requests:
+        # Здоровье драйвера отслеживает сторож
+        if not driver_healthy(driver):
+            print("Драйвер потерял соединение во время обработки")
+            return None
+        if recycle_pending():
+            print("Браузер будет перезапущен, остальные заявки - после перезапуска")
+            break
+        
+        # Загружаем страницу заново для каждой заявки
+        if not safe_get(driver, ORDERS_LIST_URL):
+            print("Не удалось загрузить страницу заявок")
+            return None
+        
+        # Обрабатываем одну заявку
+        req_id, success = process_single_request(driver, processed)
+        
+        if req_id is None:
+            # Нет новых заявок для обработки
+            print("Все доступные заявки по указанным предметам обработаны.")
+            break
+        
+        if success:
+            processed_in_session += 1
+            print(f"Заявка {req_id} успешно обработана. Обработано в этой сессии: {processed_in_session}")
+            
+            # Небольшая пауза между заявками
+            pause(random.uniform(3, 7))
+        else:
+            print(f"Ошибка при обработке заявки {req_id}")
+            record_order_failure(req_id)
+            # При ошибке тоже делаем паузу
+            pause(5 / SPEED_FACTOR)
+
+    return processed_in_session
+
+@traced("cycle")
 def check_requests(driver):
     """Проверка и обработка заявок с улучшенной обработкой ошибок"""
+    commands_before = webdriver_commands()
+    miss_seconds_before = METRICS.get("locator_miss_seconds", 0)
     try:
         processed = load_processed_requests()
-        processed_in_session = 0
         max_requests_per_session = 10  # Максимум заявок за один цикл
+
+        if BATCH_MODE:
+            processed_in_session = check_requests_batch(driver, processed, max_requests_per_session)
+        else:
+            processed_in_session = check_requests_one_by_one(driver, processed, max_requests_per_session)
+
+        store.flush()
+
+        if processed_in_session is None:
+            return False
         
-        while processed_in_session < max_requests_per_session:
-            # Проверяем здоровье драйвера перед каждой итерацией
-            if not check_driver_health(driver):
-                print("Драйвер потерял соединение во время обработки")
-                return False
-            
-            # Загружаем страницу заново для каждой заявки
-            if not safe_get(driver, "https://repetit.ru/lk/teacher/neworders"):
-                print("Не удалось загрузить страницу заявок")
-                return False
-            
-            # Обрабатываем одну заявку
-            req_id, success = process_single_request(driver, processed)
-            
-            if req_id is None:
-                # Нет новых заявок для обработки
-                print("Все доступные заявки по указанным предметам обработаны.")
-                break
-            
-            if success:
-                processed_in_session += 1
-                print(f"Заявка {req_id} успешно обработана. Обработано в этой сессии: {processed_in_session}")
-                
-                # Небольшая пауза между заявками
-                time.sleep(random.uniform(3, 7))
-            else:
-                print(f"Ошибка при обработке заявки {req_id}")
-                # При ошибке тоже делаем паузу
-                time.sleep(5 / SPEED_FACTOR)
-        
+        print(f"Ожидания ({WAIT_MODE}): {wait_summary()}")
+        cycle_round_trips = webdriver_commands() - commands_before
+        observe("cycle_round_trips", cycle_round_trips, buckets=COUNT_BUCKETS)
+        print(f"Команд WebDriver за цикл: {cycle_round_trips}")
+        cycle_miss_seconds = METRICS.get("locator_miss_seconds", 0) - miss_seconds_before
+        observe("cycle_locator_miss_seconds", cycle_miss_seconds)
+        print(f"Ожидание на промахах поиска за цикл: {cycle_miss_seconds:.2f} сек")
+
         if processed_in_session > 0:
             print(f"Сессия завершена. Обработано заявок: {processed_in_session}")
         else:
@@ -549,93 +2669,865 @@ def check_requests(driver):
     
     return True
 
+# ===== СТОРОЖ БРАУЗЕРА =====
+# Отдельный поток следит за Chrome вне основного цикла: проверяет, что браузер
+# отвечает (только если основной цикл давно не получал от него ответа),
+# считает память дерева процессов chromedriver + Chrome и после превышения
+# BROWSER_MAX_RSS_MB или BROWSER_MAX_UPTIME просит перезапустить браузер.
+# Перезапуск делает основной цикл между заявками, а не посреди чата.
+# Зависший браузер сторож убивает сам, чтобы основной цикл не ждал вечно.
+
+def process_tree_pids(root_pid):
+    """Процесс root_pid и все его потомки по /proc"""
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                stat = f.read()
+            parents[int(entry)] = int(stat.rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+
+    tree = {root_pid}
+    changed = True
+    while changed:
+        changed = False
+        for pid, ppid in parents.items():
+            if ppid in tree and pid not in tree:
+                tree.add(pid)
+                changed = True
+    return tree
+
+def process_tree_rss(root_pid):
+    """Суммарный RSS процесса и всех его потомков, в байтах"""
+    total = 0
+    for pid in process_tree_pids(root_pid):
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+    return total
+
+class Watchdog:
+    """Фоновый сторож одного экземпляра браузера"""
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.pid = driver.service.process.pid
+        self.started = time.monotonic()
+        self.last_heartbeat = time.monotonic()
+        self.alive = True
+        self.recycle_reason = None
+        self.pinger = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="watchdog", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(WATCHDOG_INTERVAL):
+            self.check_hang()
+            # Пинг в своём потоке: зависший запрос не должен останавливать сторожа
+            if self.alive and (self.pinger is None or not self.pinger.is_alive()):
+                self.pinger = threading.Thread(target=self.heartbeat, name="watchdog-ping", daemon=True)
+                self.pinger.start()
+            self.check_limits()
+
+    def heartbeat(self):
+        """Пингуем браузер, только если основной цикл давно не получал от него ответа"""
+        if time.monotonic() - self.driver.last_command_ok < WATCHDOG_INTERVAL:
+            self.last_heartbeat = time.monotonic()
+            return
+        try:
+            self.driver.window_handles
+            self.last_heartbeat = time.monotonic()
+        except Exception as e:
+            if not self.stopped.is_set():
+                print(f"Сторож: браузер не отвечает: {e}")
+                self.alive = False
+
+    def check_hang(self):
+        silent = time.monotonic() - max(self.last_heartbeat, self.driver.last_command_ok)
+        if self.alive and silent > WATCHDOG_HANG_TIMEOUT:
+            print(f"Сторож: браузер молчит {silent:.0f} сек, завершаем его процессы")
+            record_metric("browser_hangs")
+            self.alive = False
+            self.kill()
+
+    def check_limits(self):
+        rss = process_tree_rss(self.pid)
+        uptime = time.monotonic() - self.started
+        set_gauge("browser_rss_bytes", rss)
+        set_gauge("browser_uptime_seconds", round(uptime))
+        if rss > BROWSER_MAX_RSS_MB * 2**20:
+            self.request_recycle(f"память браузера {rss / 2**20:.0f} МБ > {BROWSER_MAX_RSS_MB} МБ")
+        elif uptime > BROWSER_MAX_UPTIME:
+            self.request_recycle(f"браузер работает {uptime / 3600:.1f} ч")
+
+    def request_recycle(self, reason):
+        if self.recycle_reason is None:
+            self.recycle_reason = reason
+            record_metric("browser_recycle_requests")
+            print(f"Сторож: нужен перезапуск браузера ({reason}), перезапустим между заявками")
+
+    def kill(self):
+        for pid in process_tree_pids(self.pid):
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                continue
+
+    def stop(self):
+        self.stopped.set()
+
+watchdog = None
+
+def start_watchdog(driver):
+    global watchdog
+    stop_watchdog()
+    watchdog = Watchdog(driver)
+
+def stop_watchdog():
+    global watchdog
+    if watchdog is not None:
+        watchdog.stop()
+        watchdog = None
+
+def driver_healthy(driver):
+    """Жив ли браузер: по данным сторожа, без запросов к драйверу"""
+    if watchdog is not None:
+        return watchdog.alive
+    return check_driver_health(driver)
+
+def recycle_pending():
+    """Сторож попросил перезапустить браузер при первой возможности"""
+    return watchdog is not None and watchdog.alive and watchdog.recycle_reason is not None
+
+# ===== ПУЛ ВКЛАДОК (WORKER_TABS > 1) =====
+# В одном авторизованном Chrome открыто WORKER_TABS вкладок. Первая сканирует
+# список заявок (основной цикл), остальные обрабатывают заявки, каждая в своём
+# потоке. Сессия WebDriver не выполняет команды параллельно, поэтому вкладки
+# по очереди берут общий замок и переключают окно, а на время пауз и ожиданий
+# (основная часть времени обработки) отдают его другим вкладкам.
+
+tab_context = threading.local()
+tab_pool = None
+
+def current_tab():
+    """Вкладка пула, которой сейчас управляет этот поток, или None"""
+    return getattr(tab_context, "tab", None)
+
+class BrowserTab:
+    """Вкладка пула: пока поток внутри with tab, браузер принадлежит ей"""
+
+    def __init__(self, pool, handle, name):
+        self.pool = pool
+        self.handle = handle
+        self.name = name
+        self.held = False
+
+    def acquire(self):
+        self.pool.lock.acquire()
+        try:
+            if self.pool.active is not self:
+                self.pool.active = None
+                self.pool.driver.switch_to.window(self.handle)
+                self.pool.active = self
+        except Exception:
+            # Окно закрыто или браузер упал: замок не должен остаться занятым,
+            # иначе остальные вкладки будут ждать его вечно
+            self.pool.lock.release()
+            raise
+        self.held = True
+
+    def release(self):
+        if self.held:
+            self.held = False
+            self.pool.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        tab_context.tab = self
+        return self
+
+    def __exit__(self, *exc):
+        tab_context.tab = None
+        self.release()
+        return False
+
+    @contextlib.contextmanager
+    def released(self):
+        """Временно отдаём браузер другим вкладкам"""
+        self.release()
+        try:
+            yield
+        finally:
+            self.acquire()
+
+    def run(self, fn, *args):
+        """Выполняет fn, взяв браузер на время вызова (для условий ожидания)"""
+        try:
+            self.acquire()
+            return fn(*args)
+        finally:
+            self.release()
+
+class SendRateLimiter:
+    """Не чаще одной отправки сообщения в SEND_MIN_INTERVAL секунд на аккаунт"""
+
+    def __init__(self, min_interval):
+        self.min_interval = min_interval
+        self.next_slot = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.min_interval
+        if delay > 0:
+            print(f"Лимит отправки: ждём {delay:.1f} сек")
+            pause(delay)
+
+send_rate_limiter = SendRateLimiter(SEND_MIN_INTERVAL)
+
+class TabPool:
+    """Координатор: раздаёт номера заявок вкладкам-обработчикам без повторов"""
+
+    def __init__(self, driver, size):
+        self.driver = driver
+        self.lock = threading.Lock()
+        self.work = queue.Queue()
+        self.in_flight = set()
+        self.stopped = threading.Event()
+
+        self.scanner = BrowserTab(self, driver.current_window_handle, "scanner")
+        self.active = self.scanner
+        self.workers = []
+        for index in range(1, size):
+            driver.switch_to.new_window("tab")
+            apply_tab_profile(driver)
+            self.workers.append(BrowserTab(self, driver.current_window_handle, f"worker-{index}"))
+        driver.switch_to.window(self.scanner.handle)
+
+        self.threads = [
+            threading.Thread(target=self.work_loop, args=(tab,), name=tab.name, daemon=True)
+            for tab in self.workers
+        ]
+        for thread in self.threads:
+            thread.start()
+        print(f"Пул вкладок запущен: 1 сканирует, {len(self.workers)} обрабатывают заявки")
+
+    def dispatch(self, limit, listed):
+        """Отдаёт обработчикам верх очереди, кроме заявок, которые уже в работе"""
+        dispatched = 0
+        if recycle_pending():
+            # Новых заявок не раздаём: браузер перезапустится, когда вкладки закончат
+            return dispatched
+        for req_id, subject in store.next_orders(limit, exclude=self.in_flight):
+            if req_id not in listed:
+                print(f"Заявки {req_id} больше нет в списке, убираем из очереди")
+                store.mark_order(req_id, ORDER_GONE)
+                continue
+            self.in_flight.add(req_id)
+            store.mark_order(req_id, ORDER_IN_PROGRESS)
+            self.work.put((req_id, subject))
+            dispatched += 1
+        if dispatched:
+            print(f"Отдано вкладкам заявок: {dispatched}, в работе: {len(self.in_flight)}")
+        return dispatched
+
+    def work_loop(self, tab):
+        while not self.stopped.is_set():
+            try:
+                req_id, subject = self.work.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                self.handle_order(tab, req_id, subject)
+            except Exception as e:
+                print(f"[{tab.name}] Ошибка при обработке заявки {req_id}: {e}")
+                record_order_failure(req_id, subject)
+            finally:
+                self.in_flight.discard(req_id)
+
+    def handle_order(self, tab, req_id, subject):
+        if req_id in store.ids or finish_sent_order(req_id, subject, store.ids):
+            store.mark_order(req_id, ORDER_DONE)
+            return
+        with tab:
+            request_card = resolve_card(self.driver, make_card(None, req_id=req_id, subject=subject))
+            if request_card is None:
+                print(f"[{tab.name}] Карточка заявки {req_id} больше не найдена")
+                store.mark_order(req_id, ORDER_GONE)
+                return
+            ok = process_card(self.driver, request_card, store.ids)
+        if ok:
+            store.mark_order(req_id, ORDER_DONE)
+            print(f"[{tab.name}] Заявка {req_id} успешно обработана")
+        else:
+            record_order_failure(req_id, subject)
+
+    def drain(self):
+        """
+        Ждём, пока вкладки доработают все розданные заявки. Для планового
+        перезапуска: новых заявок dispatch уже не раздаёт, а чат посреди
+        отправки обрывать нельзя, поэтому ждём без ограничения по времени.
+        """
+        started = time.monotonic()
+        reported = 0
+        while self.in_flight and any(thread.is_alive() for thread in self.threads):
+            waited = time.monotonic() - started
+            if waited >= reported:
+                print(f"Ждём, пока вкладки доработают заявки: {len(self.in_flight)} в работе")
+                reported += 30
+            time.sleep(0.5)
+
+    def stop(self, timeout=120):
+        """
+        Останавливаем обработчиков, ожидая их не дольше timeout секунд на всех;
+        заявки в работе вернутся в очередь при следующем запуске
+        """
+        self.stopped.set()
+        deadline = time.monotonic() + timeout
+        for thread in self.threads:
+            thread.join(timeout=max(0, deadline - time.monotonic()))
+            if thread.is_alive():
+                record_metric("tab_pool_stop_timeouts")
+                print(f"[{thread.name}] Вкладка не закончила заявку за {timeout} сек, закрываем без неё")
+        store.requeue_interrupted()
+
+def start_tab_pool(driver):
+    global tab_pool
+    if WORKER_TABS > 1 and ENGINE == "poll" and tab_pool is None:
+        tab_pool = TabPool(driver, WORKER_TABS)
+
+def stop_tab_pool(drain=False):
+    """Останавливаем пул; с drain=True сначала ждём, пока вкладки доработают заявки"""
+    global tab_pool
+    if tab_pool is not None:
+        if drain:
+            tab_pool.drain()
+        tab_pool.stop()
+        tab_pool = None
+
+def scanner_tab():
+    """Контекст основного цикла: вкладка-сканер пула или ничего без пула"""
+    return tab_pool.scanner if tab_pool is not None else contextlib.nullcontext()
+
+# ===== ДВИЖОК НА СЕТЕВЫХ СОБЫТИЯХ (ENGINE = "cdp") =====
+# Список заявок на странице подгружается XHR-запросами. Chrome складывает
+# сетевые события в performance-лог, пока бот занят чем угодно, поэтому
+# ни одно событие не теряется: детектор читает лог каждые CDP_POLL_INTERVAL
+# секунд, достаёт JSON-ответы со списком заявок и кладёт новые номера в
+# очередь, а обработчик забирает их без перезагрузки страницы. Полная
+# перезагрузка списка остаётся запасным вариантом раз в CDP_FALLBACK_RELOAD.
+# Все команды драйвера идут через один поток-исполнитель: сессия Selenium
+# не допускает параллельных команд, но ожидания и чтение лога чередуются.
+
+def enable_network_events(driver):
+    """Включаем домен Network в CDP, чтобы получать тела ответов"""
+    driver.execute_cdp_cmd("Network.enable", {})
+
+def order_ids_from_json(data):
+    """Номера заявок из JSON-ответа"""
+    return {card_from_order_json(order)["id"] for order in iter_order_dicts(data)}
+
+def drain_network_events(driver, pending):
+    """
+    Читаем накопившиеся сетевые события и возвращаем номера заявок из
+    завершившихся JSON-ответов, URL которых подходит под ORDERS_XHR_PATTERN.
+    pending - словарь requestId -> url ответов, тела которых ещё не готовы.
+    """
+    order_ids = set()
+    finished = []
+    for entry in driver.get_log("performance"):
+        try:
+            message = json.loads(entry["message"])["message"]
+        except (KeyError, ValueError):
+            continue
+        method = message.get("method")
+        params = message.get("params", {})
+        if method == "Network.responseReceived":
+            response = params.get("response", {})
+            if ("json" in response.get("mimeType", "")
+                    and re.search(ORDERS_XHR_PATTERN, response.get("url", ""))):
+                pending[params["requestId"]] = response["url"]
+        elif method == "Network.loadingFinished" and params.get("requestId") in pending:
+            finished.append(params["requestId"])
+
+    for request_id in finished:
+        url = pending.pop(request_id)
+        try:
+            body = driver.execute_cdp_cmd("Network.getResponseBody", {"requestId": request_id})
+            order_ids |= order_ids_from_json(json.loads(body.get("body") or "null"))
+        except (WebDriverException, ValueError) as e:
+            print(f"Не удалось разобрать ответ {url}: {e}")
+    return order_ids
+
+async def run_cdp_engine(driver):
+    """
+    Асинхронный цикл: детектор новых заявок по сетевым событиям и обработчик
+    очереди работают одновременно. Возвращает False, если драйвер сломался.
+    """
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=1)
+    queue = asyncio.Queue()
+    pending_responses = {}
+    known_ids = set(load_processed_requests())
+    state = {"busy": False}
+
+    def call(fn, *args):
+        return loop.run_in_executor(executor, fn, *args)
+
+    async def detector():
+        last_reload = 0
+        while True:
+            if not driver_healthy(driver):
+                print("Драйвер потерял соединение")
+                return False
+            if recycle_pending() and not state["busy"]:
+                # Между заявками: отдаём браузер основному циклу на перезапуск
+                return True
+
+            if time.monotonic() - last_reload >= CDP_FALLBACK_RELOAD and queue.empty():
+                # Запасной путь: полная загрузка списка, заодно порождает XHR
+                if not await call(safe_get, driver, ORDERS_LIST_URL):
+                    return False
+                last_reload = time.monotonic()
+                await queue.put(None)  # разобрать список целиком
+
+            new_ids = await call(drain_network_events, driver, pending_responses) - known_ids
+            if new_ids:
+                print(f"По сетевым событиям найдены новые заявки: {', '.join(sorted(new_ids))}")
+                known_ids.update(new_ids)
+                for req_id in sorted(new_ids):
+                    await queue.put(req_id)
+
+            await asyncio.sleep(CDP_POLL_INTERVAL)
+
+    async def processor():
+        while True:
+            await queue.get()
+            # Забираем всё, что накопилось, и обрабатываем одним проходом по списку
+            while not queue.empty():
+                queue.get_nowait()
+            processed = load_processed_requests()
+            state["busy"] = True
+            try:
+                result = await call(check_requests_batch, driver, processed, 10, False)
+            finally:
+                state["busy"] = False
+            await call(store.flush)
+            if result:
+                # Возвращаемся к списку, чтобы снова получать его XHR-обновления
+                await call(return_to_list, driver)
+            if result is None:
+                return False
+            known_ids.update(processed)
+
+    tasks = [asyncio.create_task(detector()), asyncio.create_task(processor())]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        return all(task.result() for task in done)
+    finally:
+        for task in tasks:
+            task.cancel()
+        executor.shutdown(wait=False)
+
+def return_to_list(driver):
+    """Открываем список заявок, если мы сейчас не на нём"""
+    if "neworders" not in driver.current_url:
+        return safe_get(driver, ORDERS_LIST_URL)
+    return True
+
+def run_engine(driver):
+    """Запускает выбранный движок проверки заявок"""
+    if ENGINE == "cdp":
+        try:
+            return asyncio.run(run_cdp_engine(driver))
+        except WebDriverException as e:
+            print(f"Движок cdp недоступен ({e}), переходим на обычный опрос")
+    return check_requests(driver)
+
+# ===== ПЛАНИРОВЩИК ОПРОСА =====
+
+class PollScheduler:
+    """
+    Решает, сколько ждать до следующей проверки: экспоненциальная пауза со
+    случайным разбросом после ошибок, короче интервал в часы, когда заявки
+    обычно приходят, длиннее - в тихие часы. Соблюдает лимит проверок в час
+    и дневной бюджет. Каждое решение пишется в лог.
+    """
+
+    def __init__(self):
+        self.failures = 0
+        self.poll_times = deque()
+        self.day = None
+        self.polls_today = 0
+        self.activity = {}
+        self.activity_days = 0
+        self.activity_loaded_at = 0
+
+    def refresh_activity(self):
+        """Раз в час пересчитываем, в какие часы приходили заявки"""
+        if time.monotonic() - self.activity_loaded_at < 3600 and self.activity_loaded_at:
+            return
+        self.activity, self.activity_days = store.hourly_activity(ACTIVITY_HISTORY_DAYS) if store else ({}, 0)
+        self.activity_loaded_at = time.monotonic()
+
+    def register_poll(self):
+        """Отмечаем очередную проверку для лимитов"""
+        now = time.time()
+        today = time.strftime("%Y-%m-%d")
+        if today != self.day:
+            self.day = today
+            self.polls_today = 0
+        self.polls_today += 1
+        self.poll_times.append(now)
+        record_metric("polls_total")
+        while self.poll_times and now - self.poll_times[0] >= 3600:
+            self.poll_times.popleft()
+        observe("polls_per_hour", len(self.poll_times), buckets=COUNT_BUCKETS)
+
+    def success(self):
+        self.failures = 0
+
+    def failure(self):
+        self.failures += 1
+
+    def activity_interval(self):
+        """Интервал опроса с учетом активности в текущий час"""
+        self.refresh_activity()
+        total = sum(self.activity.values())
+        if total < ACTIVITY_MIN_ORDERS or self.activity_days < ACTIVITY_MIN_DAYS:
+            return CHECK_INTERVAL, f"мало истории: {total} заявок за {self.activity_days} дн."
+        hour = time.localtime().tm_hour
+        # Сглаживание +1 на каждый час: единичная заявка не делает остальные часы тихими
+        ratio = (self.activity.get(hour, 0) + 1) / ((total + 24) / 24)
+        interval = min(POLL_MAX_INTERVAL, max(POLL_MIN_INTERVAL, CHECK_INTERVAL / ratio))
+        return interval, f"активность часа {hour}: x{ratio:.2f}"
+
+    def next_delay(self):
+        """Пауза до следующей проверки и причина"""
+        if self.failures:
+            delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (self.failures - 1))
+            delay = random.uniform(delay / 2, delay)
+            reason = f"ошибок подряд: {self.failures}"
+        else:
+            delay, reason = self.activity_interval()
+            delay *= random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+
+        # Лимит проверок за последний час
+        now = time.time()
+        while self.poll_times and now - self.poll_times[0] >= 3600:
+            self.poll_times.popleft()
+        if len(self.poll_times) >= MAX_POLLS_PER_HOUR:
+            wait = self.poll_times[0] + 3600 - now
+            if wait > delay:
+                delay, reason = wait, f"лимит {MAX_POLLS_PER_HOUR} проверок в час"
+
+        # Дневной бюджет
+        if self.day == time.strftime("%Y-%m-%d") and self.polls_today >= DAILY_POLL_CAP:
+            tomorrow = time.mktime(time.strptime(self.day, "%Y-%m-%d")) + 86400
+            delay, reason = max(delay, tomorrow - now), f"дневной бюджет {DAILY_POLL_CAP} проверок исчерпан"
+
+        return delay, reason
+
+    def sleep(self):
+        delay, reason = self.next_delay()
+        print(f"Планировщик: следующая проверка через {delay:.0f} сек ({reason}; "
+              f"проверок за час: {len(self.poll_times)}, за день: {self.polls_today})")
+        time.sleep(delay)
+
+# ===== АНАЛИТИКА: python bot.py stats =====
+# Отчёт по журналу order_events за окно времени: задержка от появления заявки
+# до открытия чата, набора и отправки (перцентили), отправки по часам и самые
+# медленные этапы. Все выборки идут по индексу времени, без чтения всей истории.
+
+LIFECYCLE_EVENTS = [STAGE_CHAT_OPENED, STAGE_TYPED, STAGE_SENT, STAGE_CONFIRMED]
+
+def parse_time_arg(value, now=None):
+    """Момент времени: "24h", "90m", "7d" назад от now или дата "2024-05-01 10:00" """
+    now = now or time.time()
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([smhd])", value.strip())
+    if match:
+        units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+        return now - float(match.group(1)) * units[match.group(2)]
+    return datetime.fromisoformat(value.strip()).timestamp()
+
+def percentile(values, share):
+    """Перцентиль по ближайшему рангу; values отсортированы"""
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, math.ceil(share * len(values)) - 1))
+    return values[index]
+
+def order_stats(conn, since, until, top=10):
+    """Сводка по журналу заявок за [since, until)"""
+    latencies = {}
+    for event in LIFECYCLE_EVENTS:
+        rows = conn.execute("""
+            SELECT e.ts - f.ts FROM order_events e
+            JOIN order_events f ON f.req_id = e.req_id AND f.event = 'first_seen'
+            WHERE e.ts >= ? AND e.ts < ? AND e.event = ?
+        """, (since, until, event)).fetchall()
+        values = sorted(max(0.0, seconds) for (seconds,) in rows)
+        latencies[event] = {
+            "count": len(values),
+            "p50": percentile(values, 0.5),
+            "p90": percentile(values, 0.9),
+            "p99": percentile(values, 0.99),
+            "max": values[-1] if values else None,
+        }
+
+    hourly = conn.execute("""
+        SELECT strftime('%Y-%m-%d %H:00', ts, 'unixepoch', 'localtime') AS hour,
+               SUM(event = 'first_seen'), SUM(event = ?), SUM(event = 'failed')
+        FROM order_events
+        WHERE ts >= ? AND ts < ?
+        GROUP BY hour ORDER BY hour
+    """, (STAGE_SENT, since, until)).fetchall()
+
+    spans = {}
+    for stage, seconds in conn.execute("""
+        SELECT detail, seconds FROM order_events
+        WHERE ts >= ? AND ts < ? AND event = 'span'
+    """, (since, until)):
+        spans.setdefault(stage, []).append(seconds)
+    slowest = sorted(
+        (
+            {"stage": stage, "count": len(values), "avg": sum(values) / len(values),
+             "p90": percentile(sorted(values), 0.9), "max": max(values)}
+            for stage, values in spans.items()
+        ),
+        key=lambda item: item["p90"],
+        reverse=True,
+    )[:top]
+
+    outcomes = dict(conn.execute("""
+        SELECT detail, COUNT(*) FROM order_events
+        WHERE ts >= ? AND ts < ? AND event = 'processed'
+        GROUP BY detail
+    """, (since, until)).fetchall())
+
+    return {"latencies": latencies, "hourly": hourly, "slowest": slowest, "outcomes": outcomes}
+
+def print_order_stats(stats, since, until):
+    def fmt(seconds):
+        return "-" if seconds is None else f"{seconds:.1f}"
+
+    print(f"Окно: {datetime.fromtimestamp(since):%Y-%m-%d %H:%M} - {datetime.fromtimestamp(until):%Y-%m-%d %H:%M}")
+    print()
+    print("От появления заявки до этапа, сек")
+    print(f"{'этап':<14} {'заявок':>7} {'p50':>8} {'p90':>8} {'p99':>8} {'макс':>8}")
+    for event, item in stats["latencies"].items():
+        print(f"{event:<14} {item['count']:>7} {fmt(item['p50']):>8} {fmt(item['p90']):>8} "
+              f"{fmt(item['p99']):>8} {fmt(item['max']):>8}")
+
+    print()
+    print("По часам")
+    print(f"{'час':<17} {'новых':>7} {'отправлено':>11} {'ошибок':>7}")
+    for hour, seen, sent, failed in stats["hourly"]:
+        print(f"{hour:<17} {seen or 0:>7} {sent or 0:>11} {failed or 0:>7}")
+
+    print()
+    print("Самые медленные этапы, сек")
+    print(f"{'этап':<24} {'раз':>6} {'ср.':>8} {'p90':>8} {'макс':>8}")
+    for item in stats["slowest"]:
+        print(f"{item['stage']:<24} {item['count']:>6} {item['avg']:>8.2f} {item['p90']:>8.2f} {item['max']:>8.2f}")
+
+    if stats["outcomes"]:
+        print()
+        print("Итоги: " + ", ".join(f"{outcome} {count}" for outcome, count in sorted(stats["outcomes"].items())))
+
+def stats_command(argv):
+    """python bot.py stats [--since 24h] [--until ...] [--db FILE] [--json]"""
+    parser = argparse.ArgumentParser(prog="bot.py stats", description="Отчёт по журналу заявок")
+    parser.add_argument("--since", default="24h", help="начало окна: 24h, 7d, 90m или дата (по умолчанию 24h)")
+    parser.add_argument("--until", help="конец окна, по умолчанию сейчас")
+    parser.add_argument("--db", default=DB_FILE, help="файл базы бота")
+    parser.add_argument("--top", type=int, default=10, help="сколько медленных этапов показать")
+    parser.add_argument("--json", action="store_true", help="вывести результат в JSON")
+    args = parser.parse_args(argv)
+
+    now = time.time()
+    since = parse_time_arg(args.since, now)
+    until = parse_time_arg(args.until, now) if args.until else now
+
+    # Только чтение: отчёт можно строить, пока бот работает
+    try:
+        conn = sqlite3.connect(f"file:{args.db}?mode=ro", uri=True)
+        try:
+            stats = order_stats(conn, since, until, top=args.top)
+        finally:
+            conn.close()
+    except sqlite3.OperationalError as e:
+        print(f"Не удалось прочитать журнал заявок из {args.db}: {e}")
+        return 1
+
+    if args.json:
+        print(json.dumps({"since": since, "until": until, **stats}, ensure_ascii=False, indent=2))
+    else:
+        print_order_stats(stats, since, until)
+    return 0
+
+# ===== ЗАМЕР ЗАПУСКА =====
+# Сколько занял каждый этап от старта процесса до первого опроса. Chrome
+# запускается в отдельном потоке параллельно с базой, поэтому сумма этапов
+# больше общего времени.
+
+startup_phases = {}
+
+@contextlib.contextmanager
+def startup_phase(name):
+    """Замер этапа запуска; повторные этапы (перезапуски браузера) не учитываем"""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        startup_phases.setdefault(name, time.monotonic() - started)
+
+def timed_startup_phase(name, fn, *args):
+    with startup_phase(name):
+        return fn(*args)
+
+def report_startup():
+    """Один раз печатаем отчёт о запуске: после первого опроса"""
+    if "total" in startup_phases:
+        return
+    startup_phases["total"] = time.monotonic() - PROCESS_STARTED
+    set_gauge("startup_seconds", round(startup_phases["total"], 3))
+    log_event("startup", **{name: round(seconds, 3) for name, seconds in startup_phases.items()})
+    parts = ", ".join(f"{name} {seconds:.2f}" for name, seconds in startup_phases.items() if name != "total")
+    print(f"Запуск до первого опроса: {startup_phases['total']:.2f} сек ({parts})")
+
 def main():
     """Основная функция с улучшенным управлением драйвером"""
+    startup_phases["imports"] = time.monotonic() - PROCESS_STARTED
     print(f"Запуск скрипта для поиска заявок по предметам: {', '.join(SUBJECTS_TO_SEARCH)}")
-    
-    init_db()
+
+    # Chrome запускается в фоне, пока открываем базу и загружаем её данные
+    launcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="browser-launch")
+    launching_driver = launcher.submit(timed_startup_phase, "browser", init_driver)
+    launcher.shutdown(wait=False)
+
+    with startup_phase("db"):
+        init_db()
+        card_locators.update(load_card_locators())
+        print(f"В базе обработанных заявок: {len(load_processed_requests())}")
+    start_metrics_server()
     
     driver = None
-    consecutive_failures = 0
-    max_consecutive_failures = 3
+    scheduler = PollScheduler()
+    soft_resets = 0
     
     while True:
         try:
             # Инициализируем драйвер, если он не существует или закрыт
             if driver is None:
                 print("Инициализируем новый драйвер...")
-                driver = init_driver()
+                if launching_driver is not None:
+                    # Первый браузер уже запускается параллельно с базой
+                    launch, launching_driver = launching_driver, None
+                    with startup_phase("browser_wait"):
+                        driver = launch.result()
+                else:
+                    driver = init_driver()
+                start_watchdog(driver)
+                soft_resets = 0
+                reset_list_snapshot()
                 
-                if not login(driver):
-                    print("Не удалось авторизоваться. Повтор через 30 секунд...")
-                    if driver:
-                        driver.quit()
-                        driver = None
-                    consecutive_failures += 1
-                    if consecutive_failures >= max_consecutive_failures:
-                        print(f"Слишком много неудачных попыток подряд ({consecutive_failures}). Увеличиваем паузу.")
-                        time.sleep(300)  # 5 минут
-                        consecutive_failures = 0
-                    else:
-                        time.sleep(30)
+                with startup_phase("login"):
+                    logged_in = ensure_logged_in(driver)
+                if not logged_in:
+                    print("Не удалось авторизоваться.")
+                    quit_driver(driver)
+                    driver = None
+                    scheduler.failure()
+                    scheduler.sleep()
                     continue
+
+                start_tab_pool(driver)
             
-            # Проверяем здоровье драйвера
-            if not check_driver_health(driver):
+            # Основной цикл работает во вкладке-сканере, обработчики пула - в своих
+            ok = False
+            with scanner_tab():
+                # Здоровье драйвера проверяет сторож в своём потоке
+                healthy = driver_healthy(driver)
+                if healthy:
+                    # Проверяем заявки
+                    scheduler.register_poll()
+                    with startup_phase("first_poll"):
+                        ok = run_engine(driver)
+                    if ok:
+                        save_session_cookies(driver)
+
+            report_startup()
+
+            if not healthy:
                 print("Драйвер потерял соединение. Переинициализация...")
-                try:
-                    driver.quit()
-                except:
-                    pass
+                stop_tab_pool()
+                quit_driver(driver)
                 driver = None
-                consecutive_failures += 1
+                scheduler.failure()
                 continue
-            
-            # Проверяем заявки
-            if check_requests(driver):
-                print(f"Проверка завершена успешно. Ожидание {CHECK_INTERVAL} сек...")
-                consecutive_failures = 0  # Сбрасываем счетчик неудач
-                time.sleep(CHECK_INTERVAL)
+
+            if ok:
+                print("Проверка завершена успешно.")
+                scheduler.success()
+                soft_resets = 0
             else:
-                print("Ошибка при проверке заявок. Переинициализация через 10 сек...")
-                consecutive_failures += 1
-                
-                if driver:
-                    try:
-                        driver.quit()
-                    except:
-                        pass
-                    driver = None
-                
-                if consecutive_failures >= max_consecutive_failures:
-                    print(f"Слишком много ошибок подряд ({consecutive_failures}). Длинная пауза.")
-                    time.sleep(300)  # 5 минут
-                    consecutive_failures = 0
+                print("Ошибка при проверке заявок.")
+                scheduler.failure()
+                stop_tab_pool()
+
+                # Сначала пробуем сбросить вкладку, и только потом перезапускаем Chrome
+                if soft_resets < MAX_SOFT_RESETS and driver_healthy(driver) and soft_reset_driver(driver):
+                    soft_resets += 1
+                    print(f"Браузер сброшен без перезапуска ({soft_resets}/{MAX_SOFT_RESETS}).")
+                    reset_list_snapshot()
+                    start_tab_pool(driver)
                 else:
-                    time.sleep(10 / SPEED_FACTOR)
+                    print("Перезапускаем браузер.")
+                    quit_driver(driver)
+                    driver = None
+
+            if driver is not None and recycle_pending():
+                # Плановый перезапуск: цикл закончен, вкладки пула дорабатывают
+                # свои заявки, и браузер закрывается только после них
+                print(f"Плановый перезапуск браузера: {watchdog.recycle_reason}")
+                record_metric("browser_recycles")
+                stop_tab_pool(drain=True)
+                save_session_cookies(driver)
+                quit_driver(driver)
+                driver = None
+            scheduler.sleep()
                 
         except KeyboardInterrupt:
             print("Получен сигнал остановки...")
+            stop_tab_pool()
             break
         except Exception as e:
             print(f"Неожиданная ошибка в main: {e}")
-            consecutive_failures += 1
+            scheduler.failure()
+            stop_tab_pool()
             
             if driver:
-                try:
-                    driver.quit()
-                except:
-                    pass
+                quit_driver(driver)
                 driver = None
                 
-            if consecutive_failures >= max_consecutive_failures:
-                print(f"Критическое количество ошибок ({consecutive_failures}). Долгая пауза.")
-                time.sleep(600)  # 10 минут
-                consecutive_failures = 0
-            else:
-                time.sleep(30)
+            scheduler.sleep()
     
+    store.close()
+
     # Закрываем драйвер при выходе
+    stop_watchdog()
     if driver:
         try:
             driver.quit()
@@ -644,4 +3536,6 @@ def main():
             pass
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["stats"]:
+        sys.exit(stats_command(sys.argv[2:]))
     main()
\ No newline at end of file